@@ -1,23 +1,37 @@
-from fastapi import FastAPI, File, UploadFile, HTTPException
+from fastapi import Depends, FastAPI, File, Header, Query, UploadFile, HTTPException
+from fastapi.concurrency import run_in_threadpool
 from fastapi.responses import JSONResponse
 from PIL import Image, UnidentifiedImageError
-import torch
+from contextlib import asynccontextmanager
+from typing import List, Literal, Optional
+import asyncio
 import io
+import math
+import os
+import zipfile
 from pathlib import Path, PosixPath
-import pathlib
-import platform
 
-# Set platform-specific path handling
-if platform.system() == 'Windows':
-    pathlib.PosixPath = pathlib.WindowsPath
-else:
-    pathlib.WindowsPath = pathlib.PosixPath
+from api.batching import MicroBatcher, QueueFullError, UnavailableError
+from api.cache import ResultCache, cache_key
+from api.encoding import encode, encode_counts, encode_curve, negotiate, render
+from api.model import load_model
+from api.threads import configure_threads, thread_config
+
+@asynccontextmanager
+async def lifespan(app):
+    """
+    Start the micro-batching scheduler with the application and stop it on shutdown.
+    """
+    await batcher.start()
+    yield
+    await batcher.stop()
 
 # Initialize the FastAPI app with metadata
 app = FastAPI(
     title="YOLOv5 Machine Learning API for CFU Counting Prediction",
     description="Apply a custom Yolov5 model on an image (jpg, png) and return the predicted positions of the CFU (JSON)",
     version="0.0.1",
+    lifespan=lifespan,
 )
 
 # Define the directory of the application and the associated Unix-compatible paths
@@ -26,21 +40,346 @@ parent_directory = app_directory.parent
 yolo_path = app_directory.parent / "yolov5"
 model_path = app_directory.parent / "models" / "20240818_UFC_counting_model_v1.0.pt"
 
-# Check if the YOLOv5 model exists, and raise an error if not found
-if not model_path.exists():
-    print(model_path)
-    raise RuntimeError(f"Model not found at {model_path}")
-
-# Load the YOLOv5 model
-model = torch.hub.load(
-    str(yolo_path), 
-    'custom', 
-    path=str(model_path), 
-    skip_validation=True, 
-    force_reload=True, 
-    source='local'
+# Batch inference settings
+IMAGE_SUFFIXES = (".jpg", ".jpeg", ".png")
+MAX_BATCH_SIZE = int(os.getenv("MAX_BATCH_SIZE", 16))  # maximum number of images per forward pass
+BATCH_WINDOW_MS = float(os.getenv("BATCH_WINDOW_MS", 10))  # time window to collect concurrent requests (ms)
+INFERENCE_WORKERS = int(os.getenv("INFERENCE_WORKERS", 1))  # number of batches run concurrently
+MAX_QUEUE_SIZE = int(os.getenv("MAX_QUEUE_SIZE", 64))  # maximum number of images waiting for inference
+INFERENCE_TIMEOUT = float(os.getenv("INFERENCE_TIMEOUT", 30))  # maximum time a request waits for its result (s)
+RETRY_AFTER = int(os.getenv("RETRY_AFTER", 1))  # delay suggested to the clients of a saturated server (s)
+DECODE_SIZE = int(os.getenv("DECODE_SIZE", 640))  # minimum size of the reduced JPEG decode, 0 for full resolution
+MIN_TILE = int(os.getenv("MIN_TILE", 320))  # minimum tile size of the sliced inference (pixels)
+MAX_TILES = int(os.getenv("MAX_TILES", 64))  # maximum number of tiles per image of the sliced inference
+MAX_ARCHIVE_IMAGES = int(os.getenv("MAX_ARCHIVE_IMAGES", 1000))  # maximum number of images per uploaded zip archive
+MAX_ARCHIVE_SIZE = int(os.getenv("MAX_ARCHIVE_SIZE", 512)) * 2**20  # maximum uncompressed size of a zip archive (MB)
+
+# Result cache settings
+MODEL_VERSION = model_path.stem  # part of the cache keys, so that a new model never serves stale results
+RESULT_CACHE_SIZE = int(os.getenv("RESULT_CACHE_SIZE", 256))  # maximum number of results kept in memory, 0 to disable
+RESULT_CACHE_TTL = float(os.getenv("RESULT_CACHE_TTL", 3600))  # time to live of a cached result (s)
+RESULT_CACHE_DB = os.getenv("RESULT_CACHE_DB")  # optional SQLite file of the on-disk cache tier
+
+# Size the thread pools of this worker (intra/inter-op, OpenCV, core pinning) before loading the model
+threads = configure_threads(**thread_config())
+print(f"Inference threads: {threads}")
+
+# Load the YOLOv5 model, from its prepared artifact when available (raise an error if the model is not found)
+model = load_model(yolo_path, model_path)
+
+# Collect concurrent requests into batched forward passes run outside of the event loop
+batcher = MicroBatcher(
+    model,
+    max_batch_size=MAX_BATCH_SIZE,
+    window_ms=BATCH_WINDOW_MS,
+    workers=INFERENCE_WORKERS,
+    max_queue_size=MAX_QUEUE_SIZE,
+    timeout=INFERENCE_TIMEOUT,
 )
 
+# Cache the results of the images analyzed before, keyed by content hash
+cache = ResultCache(max_entries=RESULT_CACHE_SIZE, ttl=RESULT_CACHE_TTL, path=RESULT_CACHE_DB)
+
+def decode_image(data, size=0):
+    """
+    Decode raw image bytes into a fully loaded PIL image, at reduced size for large JPEGs.
+
+    JPEGs are decoded with DCT scaling (by 1/2, 1/4 or 1/8) to the smallest size whose longest side is still at
+    least `size`, which is much faster than a full decode followed by a resize to the inference size.
+
+    Args:
+        data (bytes): The encoded image (png, jpg).
+        size (int): The minimum longest side of the decoded image, 0 for a full-resolution decode.
+
+    Returns:
+        tuple: The decoded image and the ratio of the original to the decoded image size.
+    """
+    image = Image.open(io.BytesIO(data))
+    width, height = image.size
+    if size and image.format == "JPEG" and max(width, height) > size:
+        ratio = size / max(width, height)
+        image.draft(None, (math.ceil(width * ratio), math.ceil(height * ratio)))
+    image.load()  # force decoding now, PIL releases the GIL while decoding
+    return image, width / image.width
+
+def unpack_uploads(filename, data):
+    """
+    Expand an uploaded file into (name, bytes) pairs, extracting the images of a zip archive.
+
+    The archive is checked against MAX_ARCHIVE_IMAGES and MAX_ARCHIVE_SIZE from its directory before any member is
+    decompressed, so that a zip bomb is rejected without being expanded.
+
+    Args:
+        filename (str): The name of the uploaded file.
+        data (bytes): The content of the uploaded file.
+
+    Returns:
+        list: A list of (name, bytes) tuples, one per image.
+
+    Raises:
+        HTTPException: 413 for an archive with too many images or too large once uncompressed.
+    """
+    if not zipfile.is_zipfile(io.BytesIO(data)):
+        return [(filename, data)]
+    with zipfile.ZipFile(io.BytesIO(data)) as archive:
+        members = [
+            member
+            for member in archive.infolist()
+            if not member.is_dir() and member.filename.lower().endswith(IMAGE_SUFFIXES)
+        ]
+        if len(members) > MAX_ARCHIVE_IMAGES:
+            raise HTTPException(status_code=413, detail=f"Too many images in {filename} (more than {MAX_ARCHIVE_IMAGES})")
+        if sum(member.file_size for member in members) > MAX_ARCHIVE_SIZE:
+            raise HTTPException(status_code=413, detail=f"{filename} is too large once uncompressed")
+        return [(Path(member.filename).name, archive.read(member)) for member in members]
+
+def response_format(format, accept):
+    """
+    Negotiate the response format of a prediction request.
+
+    Args:
+        format (str, optional): The `format` query parameter.
+        accept (str, optional): The Accept header.
+
+    Returns:
+        str: The response format name.
+    """
+    try:
+        return negotiate(format, accept)
+    except ValueError as e:
+        raise HTTPException(status_code=406, detail=str(e))
+
+async def infer(images, **options):
+    """
+    Run the images through the micro-batching scheduler, shedding the load when it is saturated.
+
+    Args:
+        images (list): The images to analyze.
+        **options: Keyword arguments of the model call, e.g. count=True.
+
+    Returns:
+        list: The YOLOv5 detections (or counts) of each image.
+    """
+    try:
+        return await batcher.submit_many(images, **options)
+    except QueueFullError as e:
+        raise HTTPException(status_code=429, detail=str(e), headers={"Retry-After": str(RETRY_AFTER)})
+    except UnavailableError as e:
+        raise HTTPException(status_code=503, detail=str(e), headers={"Retry-After": str(RETRY_AFTER)})
+
+class PredictParams:
+    """
+    Query parameters and headers shared by the prediction endpoints.
+    """
+
+    def __init__(
+        self,
+        format: Optional[str] = None,
+        mode: Literal["boxes", "count", "curve"] = "boxes",
+        threshold: float = Query(0.0, ge=0, le=1),
+        bins: int = Query(0, ge=0, le=100),
+        floor: float = Query(0.05, ge=0, le=1),
+        scale: float = Query(1.0, gt=0),
+        tile: int = Query(0, ge=0),
+        overlap: float = Query(0.2, ge=0, lt=1),
+        merge: Literal["nms", "wbf"] = "nms",
+        roi: bool = False,
+        adaptive: bool = False,
+        conf: Optional[float] = Query(None, ge=0, le=1),
+        iou: Optional[float] = Query(None, ge=0, le=1),
+        max_det: Optional[int] = Query(None, ge=1),
+        accept: Optional[str] = Header(None),
+    ):
+        """
+        Collect the parameters of a prediction request.
+
+        Args:
+            format (str, optional): The response format (json, columns, msgpack, float32), else negotiated from Accept.
+            mode (str): "boxes" to return every bounding box, "count" to only return the number of detections, "curve"
+                to return the count-vs-threshold curve computed from a single inference at the `floor` threshold.
+            threshold (float): In count and curve modes, only the detections with a confidence above this threshold
+                are counted.
+            bins (int): In count mode, the number of confidence bins of the optional histogram (0 for none, at most
+                100).
+            floor (float): In curve mode, the confidence threshold of the inference, i.e. the lowest point of the curve.
+            scale (float): The ratio of the original to the uploaded image size when the client downscaled the image,
+                the boxes are mapped back to the original coordinates.
+            tile (int): The tile size of the sliced inference at native resolution, for dense plates (0 to disable,
+                else at least MIN_TILE).
+            overlap (float): The overlap between two tiles, as a fraction of the tile size.
+            merge (str): The merge of the detections across tile seams, "nms" or "wbf" (weighted box fusion).
+            roi (bool): Whether to crop the images to their Petri dish before inference and drop the detections
+                outside it.
+            adaptive (bool): Whether to choose the inference resolution from a quick low-resolution pass, the chosen
+                resolution is reported in the response.
+            conf (float, optional): The NMS confidence threshold of this request, the model default if not set.
+            iou (float, optional): The NMS IoU threshold of this request, the model default if not set.
+            max_det (int, optional): The maximum number of detections per image of this request, the model default if
+                not set.
+            accept (str, optional): The Accept header.
+
+        Raises:
+            HTTPException: 422 for a tile size below MIN_TILE.
+        """
+        if 0 < tile < MIN_TILE:
+            raise HTTPException(status_code=422, detail=f"tile must be 0 or at least {MIN_TILE} pixels")
+        self.format = format
+        self.mode = mode
+        self.threshold = threshold
+        self.bins = bins
+        self.floor = floor
+        self.scale = scale
+        self.tile = tile
+        self.overlap = overlap
+        self.merge = merge
+        self.roi = roi
+        self.adaptive = adaptive
+        self.conf = conf
+        self.iou = iou
+        self.max_det = max_det
+        self.accept = accept
+
+    def model_options(self):
+        """
+        Collect the model call options of the request, leaving out the ones at their default.
+
+        Returns:
+            dict: Keyword arguments of the model call.
+        """
+        options = {"tile": self.tile, "overlap": self.overlap, "merge": self.merge} if self.tile else {}
+        if self.roi:
+            options["roi"] = True
+        if self.adaptive and not self.tile:
+            options["adaptive"] = True
+        nms = (("conf", self.conf), ("iou", self.iou), ("max_det", self.max_det))
+        options.update({k: v for k, v in nms if v is not None})
+        if self.mode == "curve":
+            options["conf"] = self.floor
+        return options
+
+def tile_count(size, tile, overlap):
+    """
+    Count the tiles of the sliced inference of an image, as split by `utils.general.tile_windows`.
+
+    Args:
+        size (tuple): The (width, height) of the image.
+        tile (int): The tile size.
+        overlap (float): The overlap between two tiles.
+
+    Returns:
+        int: The number of tiles.
+    """
+    step = max(1, int(tile * (1 - overlap)))
+    return math.prod(1 if n <= tile else len(range(0, n - tile, step)) + 1 for n in size)
+
+async def adaptive_infer(data, images, decode_scales, **options):
+    """
+    Run the adaptive-resolution inference: a quick pass on the reduced decodes, then a re-run of the images needing a
+    larger size, re-decoded at the resolution of their second pass only.
+
+    Args:
+        data (list): The encoded images.
+        images (list): The decoded images.
+        decode_scales (list): The ratio of the native to the decoded size of each image.
+        **options: Keyword arguments of the model call, e.g. count=True.
+
+    Returns:
+        tuple: The YOLOv5 detections (or counts) and the ratio of the native to the decoded size of each image.
+    """
+    sizes = model.adaptive_sizes
+    results = await infer(images, size=sizes[0], **options)  # quick pass
+    images, decode_scales, groups = list(images), list(decode_scales), {}
+    for i, (r, s) in enumerate(zip(results, decode_scales)):
+        size = model.adaptive_size(r.pred[0], r.shapes[0], options.get("max_det"), s)
+        native = [round(x * s) for x in images[i].size]
+        if not size and tile_count(native, sizes[1], 0.2) > MAX_TILES:  # too many tiles, run at the largest size
+            size = sizes[-1]
+        if size != sizes[0]:
+            groups.setdefault(size, []).append(i)
+
+    for size, idx in groups.items():
+        tile = 0 if size else sizes[1]
+        redecode = [i for i in idx if decode_scales[i] > 1 and (not size or size > max(images[i].size))]
+        decoded = await asyncio.gather(*(run_in_threadpool(decode_image, data[i], size) for i in redecode))
+        for i, (image, s) in zip(redecode, decoded):
+            images[i], decode_scales[i] = image, s
+        rerun = await infer([images[i] for i in idx], size=size or tile, tile=tile, **options)
+        for i, r in zip(idx, rerun):
+            results[i] = r
+    return results, decode_scales
+
+def lookup(data, settings):
+    """
+    Look an image up in the result cache.
+
+    Args:
+        data (bytes): The encoded image.
+        settings (tuple): The model version, NMS settings and request options.
+
+    Returns:
+        tuple: The cache key and the cached (predictions, inference size), None on a cache miss.
+    """
+    key = cache_key(data, *settings)
+    return key, cache.get(key)
+
+async def analyze(uploads, fmt, mode="boxes", threshold=0.0, bins=0, scale=1.0, **options):
+    """
+    Predict the objects of uploaded images, serving the images analyzed before from the result cache.
+
+    Args:
+        uploads (list): The (name, bytes) of each uploaded image.
+        fmt (str): The response format.
+        mode (str): "boxes", "count" or "curve".
+        threshold (float): In count and curve modes, the confidence threshold of the counted detections.
+        bins (int): In count mode, the number of confidence bins of the optional histogram.
+        scale (float): The ratio of the original to the uploaded image size, applied to the box coordinates.
+        **options: Keyword arguments of the model call, e.g. tile=1024 for sliced inference.
+
+    Returns:
+        tuple: The encoded predictions (or count summaries) of each image, the inference size of each image and the
+            number of cache hits.
+    """
+    # Tiles and dish crops are cut at native resolution, the adaptive mode re-decodes the images of its second pass
+    decode_size = 0 if options.get("tile") or options.get("roi") else DECODE_SIZE
+    settings = (MODEL_VERSION, model.conf, model.iou, model.max_det, decode_size, mode, fmt, threshold, bins, scale)
+    settings += tuple(sorted(options.items()))
+    cached = await asyncio.gather(*(run_in_threadpool(lookup, data, settings) for _, data in uploads))
+    keys, entries = [list(x) for x in zip(*cached)]
+    missing = [i for i, entry in enumerate(entries) if entry is None]
+    if not missing:
+        return [p for p, _ in entries], [s for _, s in entries], len(uploads)
+
+    try:
+        # Decode the images concurrently, outside of the event loop
+        decoded = await asyncio.gather(*(run_in_threadpool(decode_image, uploads[i][1], decode_size) for i in missing))
+    except UnidentifiedImageError:
+        # Raise an error if one of the uploaded files is not a valid image
+        raise HTTPException(status_code=400, detail="Invalid image format")
+    images, decode_scales = zip(*decoded)
+    if options.get("tile") and any(tile_count(im.size, options["tile"], options["overlap"]) > MAX_TILES for im in images):
+        raise HTTPException(status_code=422, detail=f"Too many tiles per image (more than {MAX_TILES}), increase tile")
+
+    count = mode in ("count", "curve")  # count-only fast path, skips the per-box outputs
+    if options.pop("adaptive", False):
+        data = [uploads[i][1] for i in missing]
+        results, decode_scales = await adaptive_infer(data, list(images), decode_scales, count=count, **options)
+    else:
+        results = await infer(list(images), count=count, **options)
+
+    if mode == "count":
+        encoded = [encode_counts(c, threshold, bins) for c in results]
+    elif mode == "curve":  # curve at the floor threshold
+        encoded = [encode_curve(c, threshold, options["conf"]) for c in results]
+    else:
+        encoded = await asyncio.gather(
+            *(run_in_threadpool(encode, r, fmt, scale * s) for r, s in zip(results, decode_scales))
+        )
+
+    for i, p, r in zip(missing, encoded, results):
+        entries[i] = (p, r.sizes[0])
+        await run_in_threadpool(cache.set, keys[i], entries[i])
+    return [p for p, _ in entries], [s for _, s in entries], len(uploads) - len(missing)
+
 # Root endpoint to welcome users to the API
 @app.get("/")
 async def home():
@@ -56,29 +395,66 @@ async def home():
 
 # Endpoint to predict objects in an uploaded image
 @app.post("/predict/")
-async def predict(file: UploadFile = File(...)):
+async def predict(file: UploadFile = File(...), params: PredictParams = Depends()):
     """
     Predict objects in an uploaded image using the YOLOv5 model.
 
     Args:
         file (UploadFile): The uploaded image file (png, jpg).
+        params (PredictParams): The query parameters and headers of the request.
 
     Returns:
-        JSONResponse: A JSON response containing the predictions.
+        Response: A response containing the predictions, JSON by default.
+
+    Raises:
+        HTTPException: 400 for an invalid image, 406 for an unknown format, 429 or 503 (with a Retry-After header) when the server is saturated.
     """
-    try:
-        # Read the uploaded image
-        image = Image.open(io.BytesIO(await file.read()))
-        
-        # Perform the prediction using the YOLOv5 model
-        results = model(image)
-
-        # Process the results and convert to JSON format
-        results_json = results.pandas().xyxy[0].to_json(orient="records")
-        
-        # Return the predictions as a JSON response
-        return JSONResponse(content={"predictions": results_json})
-    
-    except UnidentifiedImageError:
-        # Raise an error if the uploaded file is not a valid image
-        raise HTTPException(status_code=400, detail="Invalid image format")
\ No newline at end of file
+    fmt = response_format(params.format, params.accept)
+    options = params.model_options()
+
+    # Perform the prediction using the YOLOv5 model (or the result cache) and convert to the response format
+    uploads = [(file.filename, await file.read())]
+    predictions, sizes, hits = await analyze(uploads, fmt, params.mode, params.threshold, params.bins, params.scale, **options)
+    headers = {"X-Cache": "hit" if hits else "miss"}
+    size = sizes[0] if "adaptive" in options else None  # the chosen resolution is reported in adaptive mode
+
+    # Return the predictions in the negotiated format
+    if params.mode != "boxes":
+        content = predictions[0] if size is None else {**predictions[0], "size": size}
+        return JSONResponse(content=content, headers=headers)
+    return render(predictions[0], fmt, names=model.names, headers=headers, scale=params.scale, sizes=size)
+
+# Endpoint to predict objects in several uploaded images at once
+@app.post("/predict/batch")
+async def predict_batch(files: List[UploadFile] = File(...), params: PredictParams = Depends()):
+    """
+    Predict objects in several uploaded images (or zip archives of images) using batched YOLOv5 inference.
+
+    Args:
+        files (List[UploadFile]): The uploaded image files (png, jpg) and/or zip archives.
+        params (PredictParams): The query parameters and headers of the request.
+
+    Returns:
+        Response: A response containing the predictions of each image in upload order, JSON by default.
+    """
+    fmt = response_format(params.format, params.accept)
+    options = params.model_options()
+    uploads = []
+    for file in files:
+        uploads.extend(await run_in_threadpool(unpack_uploads, file.filename, await file.read()))
+    if not uploads:
+        raise HTTPException(status_code=400, detail="No image found in the request")
+
+    # Perform the predictions, the scheduler groups the images by batches of MAX_BATCH_SIZE
+    predictions, sizes, hits = await analyze(uploads, fmt, params.mode, params.threshold, params.bins, params.scale, **options)
+    headers = {"X-Cache-Hits": str(hits)}
+    sizes = sizes if "adaptive" in options else None  # the chosen resolutions are reported in adaptive mode
+
+    # Return the predictions of each image in the negotiated format
+    files = [name for name, _ in uploads]
+    if params.mode != "boxes":
+        predictions = [{"file": name, **p} for name, p in zip(files, predictions)]
+        if sizes is not None:
+            predictions = [{**p, "size": s} for p, s in zip(predictions, sizes)]
+        return JSONResponse(content={"predictions": predictions}, headers=headers)
+    return render(predictions, fmt, names=model.names, files=files, headers=headers, scale=params.scale, sizes=sizes)
@@ -0,0 +1,193 @@
+import asyncio
+import contextlib
+import math
+from concurrent.futures import ThreadPoolExecutor
+
+
+class QueueFullError(Exception):
+    """Raised when the inference queue cannot accept more images."""
+
+
+class UnavailableError(Exception):
+    """Raised when the scheduler is not running or when a request waited too long for its result."""
+
+
+class MicroBatcher:
+    """
+    Dynamic micro-batching scheduler in front of a YOLOv5 AutoShape model.
+
+    Requests arriving within a short time window are collected (up to a maximum batch size) and run as one
+    batched forward pass on a bounded pool of inference threads, so that the event loop is never blocked by
+    PyTorch and concurrent clients get batch throughput without batching themselves. The queue is bounded:
+    when it is full, requests are rejected immediately instead of letting latency grow without bound. Requests with
+    more images than the queue can ever hold are fed to it as slots free up, and their timeout grows with the number
+    of forward passes they need.
+
+    Requests are batched together when they share the same model call options, except the per-image options (the
+    NMS settings by default) which are passed to the model as per-image lists, so that they only split the NMS stage.
+    """
+
+    def __init__(
+        self,
+        model,
+        max_batch_size=16,
+        window_ms=10,
+        workers=1,
+        max_queue_size=64,
+        timeout=30,
+        per_image=("conf", "iou", "max_det"),
+    ):
+        """
+        Initialize the scheduler.
+
+        Args:
+            model (AutoShape): The YOLOv5 model called on lists of images.
+            max_batch_size (int): The maximum number of images per forward pass.
+            window_ms (float): How long to wait for more requests after the first one of a batch (milliseconds).
+            workers (int): The number of batches run concurrently by the inference threads.
+            max_queue_size (int): The maximum number of images waiting for inference.
+            timeout (float): How long a request may wait for its result, per forward pass of `max_batch_size` images
+                (seconds).
+            per_image (tuple): The model call options that may differ between the images of a forward pass.
+        """
+        self.model = model
+        self.max_batch_size = max_batch_size
+        self.window = window_ms / 1000
+        self.workers = workers
+        self.max_queue_size = max_queue_size
+        self.timeout = timeout
+        self.per_image = per_image
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="inference")
+        self.queue = None
+        self.tasks = []
+
+    @property
+    def running(self):
+        """Whether the scheduler accepts requests."""
+        return bool(self.tasks)
+
+    async def start(self):
+        """Start collecting requests, must be called from the running event loop."""
+        self.queue = asyncio.Queue(maxsize=self.max_queue_size)
+        self.tasks = [asyncio.create_task(self._run()) for _ in range(self.workers)]
+
+    async def stop(self):
+        """Stop collecting requests and wait for the scheduler tasks to finish."""
+        tasks, self.tasks = self.tasks, []
+        for task in tasks:
+            task.cancel()
+        for task in tasks:
+            with contextlib.suppress(asyncio.CancelledError):
+                await task
+        self.executor.shutdown(wait=True)
+
+    async def submit(self, image, **options):
+        """
+        Queue an image for inference and wait for its result.
+
+        Args:
+            image (Image): The image to analyze.
+            **options: Keyword arguments of the model call, e.g. count=True.
+
+        Returns:
+            Detections: The YOLOv5 detections of this image only.
+        """
+        return (await self.submit_many([image], **options))[0]
+
+    async def submit_many(self, images, **options):
+        """
+        Queue several images for inference and wait for their results.
+
+        The images are accepted all or none, except when there are more of them than the queue can hold: they are then
+        fed to the queue as slots free up, so that a large request is never rejected by an idle server. Images queued
+        with different options are run in separate forward passes, except for the per-image options.
+
+        Args:
+            images (list): The images to analyze.
+            **options: Keyword arguments of the model call, e.g. count=True.
+
+        Returns:
+            list: The YOLOv5 detections of each image, in the same order.
+
+        Raises:
+            QueueFullError: If the queue has not enough free slots for all the images (or, for a request larger than
+                the queue, for a first batch of images).
+            UnavailableError: If the scheduler is not running or the results took longer than the timeout.
+        """
+        if not self.running:
+            raise UnavailableError("Inference scheduler is not running")
+        free = self.max_queue_size - self.queue.qsize()
+        if len(images) > free and (len(images) <= self.max_queue_size or free < min(self.max_batch_size, self.max_queue_size)):
+            raise QueueFullError(f"Inference queue is full ({self.queue.qsize()}/{self.max_queue_size} images)")
+
+        loop = asyncio.get_running_loop()
+        per_image = {k: options.pop(k) for k in self.per_image if k in options}
+        key = tuple(sorted(options.items()))
+        futures = [loop.create_future() for _ in images]
+        items = [(image, key, per_image, future) for image, future in zip(images, futures)]
+        feeder = None
+        if len(items) <= free:
+            for item in items:
+                self.queue.put_nowait(item)
+        else:  # larger than the queue, fed as the scheduler frees slots
+            feeder = asyncio.create_task(self._feed(items))
+        timeout = self.timeout * math.ceil(len(images) / self.max_batch_size)
+        try:
+            return await asyncio.wait_for(asyncio.gather(*futures), timeout)
+        except asyncio.TimeoutError:
+            raise UnavailableError(f"Inference took longer than {timeout}s")
+        finally:
+            if feeder is not None:
+                feeder.cancel()
+
+    async def _feed(self, items):
+        """Put the requests of a large request into the queue, waiting for free slots."""
+        for item in items:
+            if item[-1].done():  # timed out
+                return
+            await self.queue.put(item)
+
+    async def _collect(self):
+        """Wait for a first request, then gather the requests arriving within the batching window."""
+        loop = asyncio.get_running_loop()
+        batch = [await self.queue.get()]
+        deadline = loop.time() + self.window
+        while len(batch) < self.max_batch_size:
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+        return [item for item in batch if not item[-1].done()]  # drop timed out requests
+
+    async def _run(self):
+        """Scheduler loop, runs each collected batch on an inference thread and dispatches the results."""
+        while True:
+            groups = {}  # requests grouped by model call options
+            for image, key, per_image, future in await self._collect():
+                groups.setdefault(key, []).append((image, per_image, future))
+            for key, items in groups.items():
+                await self._dispatch(items, dict(key))
+
+    async def _dispatch(self, items, options):
+        """Run one group of requests sharing the same options and set the result of each request."""
+        loop = asyncio.get_running_loop()
+        images = [image for image, _, _ in items]
+        for k in {k for _, per_image, _ in items for k in per_image}:  # per-image lists, None for the model default
+            options[k] = [per_image.get(k) for _, per_image, _ in items]
+        try:
+            results = await loop.run_in_executor(self.executor, self._infer, images, options)
+        except Exception as e:
+            for *_, future in items:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        for (*_, future), result in zip(items, results):
+            if not future.done():  # the client may have gone away
+                future.set_result(result)
+
+    def _infer(self, images, options):
+        """Run one batched forward pass and split the results per image."""
+        return self.model(images, **options).tolist()
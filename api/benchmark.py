@@ -0,0 +1,123 @@
+"""
+Benchmark of the letterbox preprocessing on typical plate resolutions.
+
+Compares the fused `letterbox` of utils.augmentations (resize straight into a padded destination, cached geometry,
+optionally reused destination) with the previous resize + copyMakeBorder implementation, and checks that both give
+the same image.
+
+Usage:
+    $ python -m api.benchmark  # synthetic plates at typical phone and scanner resolutions
+    $ python -m api.benchmark assets/sample/*.jpg --size 640 --runs 200
+"""
+
+import argparse
+import sys
+import time
+
+import cv2
+import numpy as np
+
+from api.model import YOLO_PATH
+
+# Typical (height, width) of the plate photos: phone cameras, scanners and the downscaled client uploads
+PLATE_SHAPES = ((4032, 3024), (3024, 3024), (2866, 2857), (1280, 1280), (960, 720), (650, 642))
+
+
+def letterbox_reference(im, new_shape=(640, 640), color=(114, 114, 114), auto=True, stride=32):
+    """
+    The previous letterbox implementation, a resize then a copyMakeBorder that both allocate.
+
+    Args:
+        im (np.ndarray): The HWC uint8 image.
+        new_shape (tuple): The (height, width) of the output.
+        color (tuple): The padding color.
+        auto (bool): Whether to pad to the minimum stride-multiple rectangle instead of new_shape.
+        stride (int): The model stride.
+
+    Returns:
+        np.ndarray: The resized and padded image.
+    """
+    shape = im.shape[:2]
+    r = min(new_shape[0] / shape[0], new_shape[1] / shape[1])
+    new_unpad = int(round(shape[1] * r)), int(round(shape[0] * r))
+    dw, dh = new_shape[1] - new_unpad[0], new_shape[0] - new_unpad[1]
+    if auto:
+        dw, dh = np.mod(dw, stride), np.mod(dh, stride)
+    dw /= 2
+    dh /= 2
+    if shape[::-1] != new_unpad:
+        im = cv2.resize(im, new_unpad, interpolation=cv2.INTER_LINEAR)
+    top, bottom = int(round(dh - 0.1)), int(round(dh + 0.1))
+    left, right = int(round(dw - 0.1)), int(round(dw + 0.1))
+    return cv2.copyMakeBorder(im, top, bottom, left, right, cv2.BORDER_CONSTANT, value=color)
+
+
+def timeit(fn, runs):
+    """
+    Time a function after a warmup call.
+
+    Args:
+        fn (callable): The function to time, called without arguments.
+        runs (int): The number of timed calls.
+
+    Returns:
+        float: The mean time of a call (milliseconds).
+    """
+    fn()
+    t = time.perf_counter()
+    for _ in range(runs):
+        fn()
+    return (time.perf_counter() - t) / runs * 1000
+
+
+def run(images=(), size=640, auto=False, runs=100):
+    """
+    Time the previous and the fused letterbox on each image and print a table.
+
+    Args:
+        images (list): The image files, the synthetic PLATE_SHAPES when empty.
+        size (int): The inference size.
+        auto (bool): Whether to pad to the minimum stride-multiple rectangle (LoadImages) instead of a square.
+        runs (int): The number of timed calls per image and implementation.
+    """
+    if str(YOLO_PATH) not in sys.path:
+        sys.path.append(str(YOLO_PATH))
+    from utils.augmentations import letterbox
+
+    if images:
+        ims = [(f, cv2.imread(str(f))) for f in images]
+    else:
+        rng = np.random.default_rng(0)
+        ims = [(f"{h}x{w}", rng.integers(0, 256, (h, w, 3), dtype=np.uint8)) for h, w in PLATE_SHAPES]
+
+    print(f"{'image':>24} {'shape':>12} {'previous':>10} {'fused':>10} {'reused':>10} {'speedup':>8}")
+    for name, im in ims:
+        expected = letterbox_reference(im, (size, size), auto=auto)
+        fused = letterbox(im, size, auto=auto)[0]
+        if not np.array_equal(expected, fused):
+            raise AssertionError(f"{name}: fused letterbox differs from the previous implementation")
+        t0 = timeit(lambda: letterbox_reference(im, (size, size), auto=auto), runs)
+        t1 = timeit(lambda: letterbox(im, size, auto=auto), runs)
+        t2 = timeit(lambda: letterbox(im, size, auto=auto, dst=fused), runs)
+        shape = "x".join(str(s) for s in im.shape[:2])
+        print(f"{str(name)[-24:]:>24} {shape:>12} {t0:>8.2f}ms {t1:>8.2f}ms {t2:>8.2f}ms {t0 / t2:>7.2f}x")
+
+
+def parse_opt():
+    """
+    Parse the command line options of the benchmark.
+
+    Returns:
+        argparse.Namespace: The parsed options.
+    """
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("images", nargs="*", help="image files, synthetic plates at typical resolutions if omitted")
+    parser.add_argument("--size", type=int, default=640, help="inference size (pixels)")
+    parser.add_argument("--auto", action="store_true", help="minimum stride-multiple rectangle instead of a square")
+    parser.add_argument("--runs", type=int, default=100, help="timed calls per image and implementation")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    opt = parse_opt()
+    run(**vars(opt))
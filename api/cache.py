@@ -0,0 +1,118 @@
+import hashlib
+import os
+import pickle
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+
+def cache_key(data, *settings):
+    """
+    Build a result cache key from the image content and every setting that changes the result.
+
+    Args:
+        data (bytes): The encoded image.
+        *settings: The model version, NMS settings and request options.
+
+    Returns:
+        str: The hexadecimal SHA-256 key.
+    """
+    h = hashlib.sha256(data)
+    h.update(repr(settings).encode())
+    return h.hexdigest()
+
+
+class ResultCache:
+    """
+    Result cache keyed by content hash: a bounded in-memory LRU with TTL, backed by an optional SQLite tier.
+
+    The on-disk tier survives restarts and is shared by the worker processes of a server, entries found there are
+    promoted to the in-memory tier. All the methods are thread-safe.
+    """
+
+    def __init__(self, max_entries=256, ttl=3600, path=None):
+        """
+        Initialize the cache.
+
+        Args:
+            max_entries (int): The maximum number of entries kept in memory, 0 to disable the cache.
+            ttl (float): The time to live of an entry (seconds).
+            path (str, optional): The SQLite database of the on-disk tier, None for memory only.
+        """
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.entries = OrderedDict()  # key -> (expiry time, value), least recently used first
+        self.lock = threading.Lock()
+        self.path = path if max_entries else None
+        self.connection = None
+        self.pid = None
+
+    @property
+    def db(self):
+        """The SQLite connection of this process (connections must not cross a fork), None for memory only."""
+        if self.path is None:
+            return None
+        if self.pid != os.getpid():
+            self.connection = sqlite3.connect(self.path, check_same_thread=False)
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS results (key TEXT PRIMARY KEY, expires REAL, value BLOB)"
+            )
+            self.connection.commit()
+            self.pid = os.getpid()
+        return self.connection
+
+    def get(self, key):
+        """
+        Return the cached value of a key, or None if it is missing or expired.
+
+        Args:
+            key (str): The cache key.
+
+        Returns:
+            object: The cached value or None.
+        """
+        if not self.max_entries:
+            return None
+        now = time.time()
+        with self.lock:
+            if key in self.entries:
+                expires, value = self.entries[key]
+                if expires > now:
+                    self.entries.move_to_end(key)
+                    return value
+                del self.entries[key]
+            db = self.db
+            if db is not None:
+                row = db.execute("SELECT expires, value FROM results WHERE key = ?", (key,)).fetchone()
+                if row and row[0] > now:
+                    value = pickle.loads(row[1])
+                    self._remember(key, row[0], value)
+                    return value
+        return None
+
+    def set(self, key, value):
+        """
+        Store the value of a key in memory and, if enabled, on disk.
+
+        Args:
+            key (str): The cache key.
+            value (object): The picklable value.
+        """
+        if not self.max_entries:
+            return
+        expires = time.time() + self.ttl
+        with self.lock:
+            self._remember(key, expires, value)
+            db = self.db
+            if db is not None:
+                db.execute("INSERT OR REPLACE INTO results VALUES (?, ?, ?)", (key, expires, pickle.dumps(value)))
+                db.execute("DELETE FROM results WHERE expires <= ?", (time.time(),))
+                db.commit()
+
+    def _remember(self, key, expires, value):
+        """Insert an entry in the in-memory LRU, evicting the least recently used entries beyond the size limit."""
+        self.entries[key] = (expires, value)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
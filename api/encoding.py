@@ -0,0 +1,184 @@
+"""
+Response formats of the prediction endpoints.
+
+- json (default): {"predictions": "<JSON string of records>"}, the historical format built with pandas.
+- columns: {"predictions": {"xmin": [...], ..., "class": [...]}, "names": {...}}, flat JSON arrays of columns.
+- msgpack: the columns payload encoded with MessagePack (requires the optional `msgpack` package).
+- float32: the raw (n, 6) float32 array of boxes (xmin, ymin, xmax, ymax, confidence, class), row-major.
+
+The compact formats are built directly from the prediction tensors, without a pandas round trip. When the client
+uploaded a downscaled image, the boxes are mapped back to the original coordinates and the scale is reported
+("scale" field, or X-Scale header of the float32 format).
+"""
+
+import bisect
+
+import numpy as np
+from fastapi.responses import JSONResponse, Response
+
+try:
+    import msgpack
+except ImportError:  # optional dependency
+    msgpack = None
+
+COLUMNS = ("xmin", "ymin", "xmax", "ymax", "confidence", "class")
+MEDIA_TYPES = {
+    "json": "application/json",
+    "columns": "application/vnd.cfu-counter.columns+json",
+    "msgpack": "application/x-msgpack",
+    "float32": "application/octet-stream",
+}
+
+
+def negotiate(fmt=None, accept=None):
+    """
+    Select the response format from the `format` query parameter, or else from the Accept header.
+
+    Args:
+        fmt (str, optional): The requested format name.
+        accept (str, optional): The Accept header of the request.
+
+    Returns:
+        str: The response format name, "json" by default.
+
+    Raises:
+        ValueError: If the requested format is unknown or unavailable.
+    """
+    if fmt is None:
+        media_types = [media.split(";")[0].strip() for media in (accept or "").split(",")]
+        fmt = next((k for media in media_types for k, v in MEDIA_TYPES.items() if v == media), "json")
+    if fmt not in MEDIA_TYPES:
+        raise ValueError(f"Unknown format '{fmt}', valid formats are {', '.join(MEDIA_TYPES)}")
+    if fmt == "msgpack" and msgpack is None:
+        raise ValueError("MessagePack format is not available, install the 'msgpack' package")
+    return fmt
+
+
+def encode(results, fmt="json", scale=1.0):
+    """
+    Encode the detections of one image in the given format.
+
+    Args:
+        results (Detections): The YOLOv5 detections of one image.
+        fmt (str): The response format name.
+        scale (float): The ratio of the original to the uploaded image size, applied to the box coordinates.
+
+    Returns:
+        str | dict | np.ndarray: The JSON string of records, the dict of columns or the float32 array of boxes.
+    """
+    if fmt == "json":
+        df = results.pandas().xyxy[0]
+        if scale != 1:
+            df[list(COLUMNS[:4])] *= scale
+        return df.to_json(orient="records")
+    a = results.pred[0].cpu().numpy().astype(np.float32, copy=False)
+    if scale != 1:
+        a = a.copy()  # do not modify the detections in place
+        a[:, :4] *= scale
+    if fmt == "float32":
+        return np.ascontiguousarray(a)
+    columns = dict(zip(COLUMNS, a[:, :5].T.tolist()))
+    columns["class"] = a[:, 5].astype(int).tolist()
+    return columns
+
+
+def encode_counts(counts, threshold=0.0, bins=0):
+    """
+    Summarize the detection counts of one image, without building any per-box output.
+
+    Args:
+        counts (Counts): The YOLOv5 counts of one image.
+        threshold (float): Only the detections with a confidence above this threshold are counted.
+        bins (int): The number of confidence bins between the threshold and 1, 0 for no histogram.
+
+    Returns:
+        dict: The count, the threshold and the optional per-bin counts.
+    """
+    summary = {"count": counts.count(threshold)[0], "threshold": threshold}
+    if bins:
+        edges, histogram = counts.histogram(bins, threshold)
+        summary["bins"] = {"edges": edges, "counts": histogram[0]}
+    return summary
+
+
+def count_above(thresholds, counts, threshold):
+    """
+    Read the number of detections with a confidence above a threshold from a count-vs-threshold curve.
+
+    Args:
+        thresholds (list): The ascending confidences of the curve.
+        counts (list): The number of detections at or above each confidence.
+        threshold (float): The confidence threshold.
+
+    Returns:
+        int: The number of detections with a confidence above the threshold.
+    """
+    i = bisect.bisect_right(thresholds, threshold)
+    return counts[i] if i < len(counts) else 0
+
+
+def encode_curve(counts, threshold=0.0, floor=0.05):
+    """
+    Summarize the count-vs-threshold curve of one image, computed from a single inference at a low floor threshold.
+
+    Args:
+        counts (Counts): The YOLOv5 counts of one image, at the floor threshold.
+        threshold (float): The threshold of the returned count (the floor if it is lower).
+        floor (float): The confidence threshold of the inference.
+
+    Returns:
+        dict: The count at the threshold, the threshold, the floor and the curve (ascending thresholds and counts).
+    """
+    thresholds, curve = counts.curve()[0]
+    return {
+        "count": count_above(thresholds, curve, max(threshold, floor)),
+        "threshold": threshold,
+        "floor": floor,
+        "curve": {"thresholds": [round(t, 4) for t in thresholds], "counts": curve},
+    }
+
+
+def render(predictions, fmt="json", names=None, files=None, headers=None, scale=1.0, sizes=None):
+    """
+    Build the HTTP response of one or several encoded predictions.
+
+    Args:
+        predictions (str | dict | np.ndarray | list): The encoded predictions of one image, or a list for a batch.
+        fmt (str): The response format name.
+        names (dict, optional): The class names of the model, added to the columns formats.
+        files (list, optional): The file names of a batch, in the same order as the predictions.
+        headers (dict, optional): Additional response headers.
+        scale (float): The ratio of the original to the uploaded image size, reported when it is not 1.
+        sizes (int | list, optional): The inference resolution of the image, or of each image of a batch, reported
+            when given.
+
+    Returns:
+        Response: The response with the media type of the format.
+    """
+    batch = files is not None
+    if fmt == "float32":
+        arrays = predictions if batch else [predictions]
+        headers = {**(headers or {}), "X-Columns": ",".join(COLUMNS)}
+        headers["X-Counts"] = ",".join(str(len(a)) for a in arrays)
+        if scale != 1:
+            headers["X-Scale"] = str(scale)
+        if sizes is not None:
+            headers["X-Sizes"] = ",".join(str(s) for s in (sizes if batch else [sizes]))
+        data = np.concatenate(arrays).tobytes() if arrays else b""
+        return Response(content=data, media_type=MEDIA_TYPES[fmt], headers=headers)
+
+    if batch:
+        predictions = [{"file": name, "predictions": p} for name, p in zip(files, predictions)]
+        if sizes is not None:
+            predictions = [{**p, "size": s} for p, s in zip(predictions, sizes)]
+    content = {"predictions": predictions}
+    if sizes is not None and not batch:
+        content["size"] = sizes
+    if scale != 1:
+        content["scale"] = scale
+    if fmt != "json":
+        names = dict(enumerate(names)) if isinstance(names, (list, tuple)) else names or {}
+        content["names"] = {str(k): v for k, v in names.items()}
+    if fmt == "msgpack":
+        return Response(content=msgpack.packb(content), media_type=MEDIA_TYPES[fmt], headers=headers)
+    return JSONResponse(content=content, media_type=MEDIA_TYPES[fmt], headers=headers)
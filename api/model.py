@@ -0,0 +1,143 @@
+"""
+Loading of the YOLOv5 CFU counting model.
+
+Loading the checkpoint through `torch.hub` resolves the hub entrypoint, checks the YOLOv5 requirements, builds a
+DetectMultiBackend and fuses the Conv+BatchNorm layers on every boot. A "prepared" artifact stores the model once
+these steps are done (fused, in eval mode, with its strides and class names), so that it can be loaded directly.
+
+Usage:
+    $ python -m api.model  # writes models/20240818_UFC_counting_model_v1.0.prepared.pt
+"""
+
+import pathlib
+import platform
+import sys
+import time
+from datetime import datetime
+from pathlib import Path
+
+import torch
+
+# Set platform-specific path handling (the checkpoint was saved on Windows)
+if platform.system() == 'Windows':
+    pathlib.PosixPath = pathlib.WindowsPath
+else:
+    pathlib.WindowsPath = pathlib.PosixPath
+
+ROOT = Path(__file__).resolve().parents[1]
+YOLO_PATH = ROOT / "yolov5"
+MODEL_PATH = ROOT / "models" / "20240818_UFC_counting_model_v1.0.pt"
+
+
+def prepared_path_for(model_path):
+    """
+    Return the path of the prepared artifact of a checkpoint.
+
+    Args:
+        model_path (Path): The YOLOv5 checkpoint.
+
+    Returns:
+        Path: The prepared artifact path, next to the checkpoint.
+    """
+    return model_path.with_suffix(".prepared.pt")
+
+
+def load_hub_model(yolo_path, model_path):
+    """
+    Load the checkpoint through the local YOLOv5 torch.hub entrypoint.
+
+    Args:
+        yolo_path (Path): The local YOLOv5 repository.
+        model_path (Path): The YOLOv5 checkpoint.
+
+    Returns:
+        AutoShape: The fused model wrapped for PIL/numpy inputs and NMS.
+    """
+    return torch.hub.load(
+        str(yolo_path),
+        'custom',
+        path=str(model_path),
+        skip_validation=True,
+        force_reload=True,
+        source='local'
+    )
+
+
+def prepare_model(yolo_path=YOLO_PATH, model_path=MODEL_PATH):
+    """
+    Load the checkpoint through torch.hub once and save the resulting inference-ready model.
+
+    Args:
+        yolo_path (Path): The local YOLOv5 repository.
+        model_path (Path): The YOLOv5 checkpoint.
+
+    Returns:
+        Path: The written prepared artifact.
+    """
+    model = load_hub_model(yolo_path, model_path).model  # AutoShape -> DetectMultiBackend
+    detection_model = model.model.float().eval()  # fused DetectionModel
+    for p in detection_model.parameters():
+        p.requires_grad = False
+    f = prepared_path_for(model_path)
+    torch.save(
+        {
+            "model": detection_model,
+            "stride": model.stride,
+            "names": model.names,
+            "source": model_path.name,
+            "torch": torch.__version__,
+            "date": datetime.now().isoformat(),
+        },
+        f,
+    )
+    return f
+
+
+def load_prepared_model(yolo_path, prepared_path):
+    """
+    Load a prepared artifact, skipping torch.hub, the requirement checks and the layer fusion.
+
+    Args:
+        yolo_path (Path): The local YOLOv5 repository, needed to unpickle the model classes.
+        prepared_path (Path): The prepared artifact.
+
+    Returns:
+        AutoShape: The model wrapped for PIL/numpy inputs and NMS.
+    """
+    if str(yolo_path) not in sys.path:
+        sys.path.append(str(yolo_path))
+    from models.common import AutoShape
+
+    ckpt = torch.load(prepared_path, map_location="cpu")
+    detection_model = ckpt["model"]
+    detection_model.names = ckpt["names"]
+    model = AutoShape(detection_model, verbose=False)
+    model.stride = ckpt["stride"]
+    return model
+
+
+def load_model(yolo_path=YOLO_PATH, model_path=MODEL_PATH):
+    """
+    Load the model from its prepared artifact when it is up to date, from torch.hub otherwise, and report the time.
+
+    Args:
+        yolo_path (Path): The local YOLOv5 repository.
+        model_path (Path): The YOLOv5 checkpoint.
+
+    Returns:
+        AutoShape: The model wrapped for PIL/numpy inputs and NMS.
+    """
+    t = time.perf_counter()
+    prepared_path = prepared_path_for(model_path)
+    if prepared_path.exists() and (not model_path.exists() or prepared_path.stat().st_mtime >= model_path.stat().st_mtime):
+        model, source = load_prepared_model(yolo_path, prepared_path), "prepared artifact"
+    elif model_path.exists():
+        model, source = load_hub_model(yolo_path, model_path), "torch.hub (run `python -m api.model` to prepare it)"
+    else:
+        raise RuntimeError(f"Model not found at {model_path}")
+    print(f"Model loaded in {time.perf_counter() - t:.2f}s from {source}")
+    return model
+
+
+if __name__ == "__main__":
+    print(f"Prepared model saved to {prepare_model()}")
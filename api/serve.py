@@ -0,0 +1,136 @@
+"""
+Multi-process inference server sharing one copy of the model weights between its workers.
+
+The parent process loads the model once, moves its weights to shared memory and forks the workers, which all
+accept connections on the same listening socket. Unlike `uvicorn --workers N`, the model is neither loaded nor
+stored N times.
+
+Usage:
+    $ python -m api.serve --host 0.0.0.0 --port 8000 --workers 4 --threads 2 --affinity auto
+"""
+
+import argparse
+import os
+import signal
+import socket
+
+import torch
+import uvicorn
+
+from api.threads import configure_threads, thread_config
+
+
+def parse_opt():
+    """
+    Parse the command line options of the server.
+
+    Returns:
+        argparse.Namespace: The parsed options.
+    """
+    config = thread_config()  # defaults from the environment or the autotuned settings
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="0.0.0.0", help="interface to bind")
+    parser.add_argument("--port", type=int, default=int(os.getenv("PORT", 8000)), help="port to bind")
+    parser.add_argument("--workers", type=int, default=2, help="number of worker processes")
+    parser.add_argument("--threads", type=int, default=config["threads"], help="intra-op threads per worker")
+    parser.add_argument("--interop-threads", type=int, default=config["interop_threads"], help="inter-op threads")
+    parser.add_argument("--affinity", default=config["affinity"], help="'auto' or a core list to pin")
+    parser.add_argument("--cv2-threads", type=int, default=config["cv2_threads"], help="OpenCV threads, 0 to disable")
+    return parser.parse_args()
+
+
+def bind_socket(host, port):
+    """
+    Create the listening socket shared by all the workers.
+
+    Args:
+        host (str): The interface to bind.
+        port (int): The port to bind.
+
+    Returns:
+        socket.socket: The bound and listening socket.
+    """
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((host, port))
+    sock.listen(2048)
+    sock.set_inheritable(True)
+    return sock
+
+
+def serve_worker(app, sock, threads, affinity="", cv2_threads=0, worker=0):
+    """
+    Run one uvicorn worker on the shared socket, must be called in the forked child.
+
+    Args:
+        app (FastAPI): The application to serve.
+        sock (socket.socket): The shared listening socket.
+        threads (int): The intra-op thread budget of this worker.
+        affinity (str): "auto" to pin each worker to its own cores, a core list, or an empty string for no pinning.
+        cv2_threads (int): The OpenCV threads of this worker.
+        worker (int): The index of this worker.
+    """
+    configure_threads(threads, affinity=affinity, cv2_threads=cv2_threads, worker=worker)
+    server = uvicorn.Server(uvicorn.Config(app, log_level="info"))
+    server.run(sockets=[sock])
+
+
+def run(host="0.0.0.0", port=8000, workers=2, threads=0, interop_threads=0, affinity="", cv2_threads=0):
+    """
+    Load the model once, then fork the workers and wait for them.
+
+    Args:
+        host (str): The interface to bind.
+        port (int): The port to bind.
+        workers (int): The number of worker processes.
+        threads (int): The intra-op threads per worker, 0 to split the cores evenly between the workers.
+        interop_threads (int): The inter-op threads per worker, 0 for the PyTorch default.
+        affinity (str): "auto" to pin each worker to its own cores, a core list, or an empty string for no pinning.
+        cv2_threads (int): The OpenCV threads per worker, 0 to disable the OpenCV multithreading.
+    """
+    if not hasattr(os, "fork"):
+        raise RuntimeError("The multi-process serving mode requires a platform with fork()")
+    threads = threads or max(1, (os.cpu_count() or 1) // workers)
+    sock = bind_socket(host, port)
+
+    # The inter-op pool cannot be resized in the forked workers, so it is sized by the parent when importing the app.
+    # The parent runs single-threaded: an OpenMP pool started before the fork (e.g. by the layer fusion of the
+    # torch.hub fallback) hangs the first inference of the workers, which size their own pools after the fork.
+    torch.set_num_threads(1)
+    os.environ.update(TORCH_THREADS="1", TORCH_INTEROP_THREADS=str(interop_threads), CV2_THREADS=str(cv2_threads))
+    os.environ.update(CPU_AFFINITY="", WEB_CONCURRENCY=str(workers))  # the workers are pinned after the fork
+
+    # Load the model in the parent only, its weights are then shared by all the forked workers
+    import api.app as server
+
+    server.model.share_memory()
+
+    children = []
+    for i in range(workers):
+        pid = os.fork()
+        if pid == 0:  # worker
+            try:
+                serve_worker(server.app, sock, threads, affinity, cv2_threads, i)
+            finally:
+                os._exit(0)
+        children.append(pid)
+    print(f"Serving on http://{host}:{port} with {workers} workers x {threads} threads (shared model weights)")
+
+    def terminate(signum, frame):
+        """Forward the termination signals to the workers."""
+        for pid in children:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    signal.signal(signal.SIGTERM, terminate)
+    signal.signal(signal.SIGINT, terminate)
+    for pid in children:
+        os.waitpid(pid, 0)
+    sock.close()
+
+
+if __name__ == "__main__":
+    opt = parse_opt()
+    run(**vars(opt))
@@ -0,0 +1,230 @@
+"""
+CPU thread configuration of the inference workers.
+
+PyTorch sizes its intra-op pool to all the cores of the host, and each uvicorn or `api.serve` worker process has its
+own pool, so several workers oversubscribe the cores. The settings of each worker are read from the environment,
+or else from the file written by the autotune command:
+
+- TORCH_THREADS: intra-op threads per worker, 0 to split the cores evenly between the workers.
+- TORCH_INTEROP_THREADS: inter-op threads per worker, 0 for the PyTorch default.
+- CPU_AFFINITY: "auto" to pin each worker of `api.serve` to its own cores, a core list (e.g. "0-3,8") to pin the
+  workers to these cores, empty for no pinning.
+- CV2_THREADS: OpenCV threads, 0 to disable the OpenCV multithreading.
+- WEB_CONCURRENCY: the number of worker processes sharing the host (set by uvicorn and Heroku).
+- THREAD_CONFIG: the JSON file of the autotuned settings (default models/threads.json).
+
+Usage:
+    $ python -m api.threads --workers 2  # sweep the settings on the sample plates, write models/threads.json
+"""
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+from itertools import product
+from pathlib import Path
+
+import cv2
+import torch
+
+from api.model import ROOT
+
+THREAD_CONFIG = Path(os.getenv("THREAD_CONFIG", ROOT / "models" / "threads.json"))  # autotuned settings file
+SAMPLE_DIR = ROOT / "assets" / "sample"  # plates used by the autotune command
+
+
+def parse_cpus(spec):
+    """
+    Parse a core list such as "0-3,8".
+
+    Args:
+        spec (str): Comma-separated core numbers and ranges.
+
+    Returns:
+        list: The sorted core numbers.
+    """
+    cpus = set()
+    for part in filter(None, (p.strip() for p in spec.split(","))):
+        first, _, last = part.partition("-")
+        cpus.update(range(int(first), int(last or first) + 1))
+    return sorted(cpus)
+
+
+def thread_config(path=THREAD_CONFIG):
+    """
+    Read the thread settings from the environment, falling back on the autotuned settings file, then on defaults.
+
+    Args:
+        path (Path): The JSON file written by the autotune command.
+
+    Returns:
+        dict: The keyword arguments of `configure_threads`.
+    """
+    config = {"threads": 0, "interop_threads": 0, "affinity": "", "cv2_threads": 0}
+    if path.exists():
+        config.update({k: v for k, v in json.loads(path.read_text()).items() if k in config})
+    environment = {"threads": "TORCH_THREADS", "interop_threads": "TORCH_INTEROP_THREADS", "cv2_threads": "CV2_THREADS"}
+    for key, env in environment.items():
+        if os.getenv(env):
+            config[key] = int(os.getenv(env))
+    config["affinity"] = os.getenv("CPU_AFFINITY", config["affinity"])
+    config["workers"] = int(os.getenv("WEB_CONCURRENCY", 1))
+    return config
+
+
+def worker_cpus(affinity, threads, worker=None):
+    """
+    Select the cores of a worker.
+
+    Args:
+        affinity (str): "auto", a core list or an empty string.
+        threads (int): The intra-op threads of the worker, the number of cores it gets with "auto".
+        worker (int, optional): The index of the worker, required by "auto".
+
+    Returns:
+        list | None: The cores of the worker, None for no pinning.
+    """
+    if not affinity or not hasattr(os, "sched_setaffinity"):
+        return None
+    if affinity != "auto":
+        return parse_cpus(affinity)
+    if worker is None:  # the worker index is only known to api.serve
+        return None
+    available = sorted(os.sched_getaffinity(0))
+    return [available[(worker * threads + i) % len(available)] for i in range(min(threads, len(available)))]
+
+
+def configure_threads(threads=0, interop_threads=0, affinity="", cv2_threads=0, workers=1, worker=None):
+    """
+    Size the thread pools of this process and optionally pin it to its cores, must be called before the first
+    inference (the inter-op pool cannot be resized once used, nor in a forked process).
+
+    Args:
+        threads (int): The intra-op threads, 0 to split the cores evenly between the workers.
+        interop_threads (int): The inter-op threads, 0 for the PyTorch default.
+        affinity (str): "auto" to pin each worker to its own cores, a core list, or an empty string for no pinning.
+        cv2_threads (int): The OpenCV threads, 0 to disable the OpenCV multithreading.
+        workers (int): The number of worker processes sharing the host.
+        worker (int, optional): The index of this worker, required by the "auto" affinity.
+
+    Returns:
+        dict: The applied settings.
+    """
+    threads = threads or max(1, (os.cpu_count() or 1) // workers)
+    cpus = worker_cpus(affinity, threads, worker)
+    if cpus:
+        os.sched_setaffinity(0, cpus)  # before the pools start, so that their threads inherit it
+    torch.set_num_threads(threads)
+    if interop_threads and interop_threads != torch.get_num_interop_threads():
+        try:
+            torch.set_num_interop_threads(interop_threads)
+        except RuntimeError:  # already set or used, e.g. by the parent of a forked worker
+            pass
+    cv2.setNumThreads(cv2_threads)
+    return {
+        "threads": threads,
+        "interop_threads": torch.get_num_interop_threads(),
+        "cpus": cpus,
+        "cv2_threads": cv2_threads,
+    }
+
+
+def measure(seconds=5, size=640, batch=1, **config):
+    """
+    Measure the inference throughput of one worker on the sample plates.
+
+    Args:
+        seconds (float): The measurement duration, after a warmup inference.
+        size (int): The inference size.
+        batch (int): The number of images per forward pass.
+        **config: The keyword arguments of `configure_threads`.
+
+    Returns:
+        float: The throughput (images per second).
+    """
+    configure_threads(**config)
+    from api.model import load_model
+
+    model = load_model()
+    ims = [cv2.imread(str(f))[..., ::-1] for f in sorted(SAMPLE_DIR.glob("*.jpg"))]  # BGR to RGB
+    batches = [ims[i : i + batch] for i in range(0, len(ims), batch)]
+    model(batches[0], size=size)  # warmup
+    n, t = 0, time.perf_counter()
+    while time.perf_counter() - t < seconds:
+        for b in batches:
+            model(b, size=size)
+            n += len(b)
+    return n / (time.perf_counter() - t)
+
+
+def autotune(workers=1, seconds=5, size=640, batch=1, output=THREAD_CONFIG):
+    """
+    Sweep the thread settings, run each in `workers` concurrent processes and write the fastest one.
+
+    Args:
+        workers (int): The number of worker processes of the server.
+        seconds (float): The measurement duration of each setting.
+        size (int): The inference size.
+        batch (int): The number of images per forward pass.
+        output (Path): The JSON file of the best settings.
+
+    Returns:
+        dict: The best settings and their total throughput.
+    """
+    cores = max(1, (os.cpu_count() or 1) // workers)
+    affinities = ("", "auto") if workers > 1 and hasattr(os, "sched_setaffinity") else ("",)
+    grid = product(
+        sorted({t for t in (1, 2, 4, 8, 16) if t < cores} | {cores}),  # intra-op threads
+        (1, 2),  # inter-op threads
+        sorted({0, cores}),  # OpenCV threads
+        affinities,
+    )
+    best = None
+    for threads, interop_threads, cv2_threads, affinity in grid:
+        args = [sys.executable, "-m", "api.threads", "--measure", f"--seconds={seconds}", f"--size={size}"]
+        args += [f"--batch={batch}", f"--threads={threads}", f"--interop-threads={interop_threads}"]
+        args += [f"--cv2-threads={cv2_threads}", f"--affinity={affinity}", f"--workers={workers}"]
+        procs = [subprocess.Popen(args + [f"--worker={i}"], stdout=subprocess.PIPE, text=True) for i in range(workers)]
+        throughput = sum(float(p.communicate()[0].strip().splitlines()[-1]) for p in procs)
+        config = {"threads": threads, "interop_threads": interop_threads, "affinity": affinity, "cv2_threads": cv2_threads}
+        print(f"{config} x {workers} workers: {throughput:.2f} images/s")
+        if best is None or throughput > best["throughput"]:
+            best = {**config, "workers": workers, "throughput": round(throughput, 2)}
+    output.write_text(json.dumps(best, indent=2))
+    print(f"Best settings {best} saved to {output}")
+    return best
+
+
+def parse_opt():
+    """
+    Parse the command line options of the autotune command.
+
+    Returns:
+        argparse.Namespace: The parsed options.
+    """
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--workers", type=int, default=int(os.getenv("WEB_CONCURRENCY", 1)), help="worker processes")
+    parser.add_argument("--seconds", type=float, default=5, help="measurement duration of each setting")
+    parser.add_argument("--size", type=int, default=640, help="inference size (pixels)")
+    parser.add_argument("--batch", type=int, default=1, help="images per forward pass")
+    parser.add_argument("--output", type=Path, default=THREAD_CONFIG, help="JSON file of the best settings")
+    parser.add_argument("--measure", action="store_true", help=argparse.SUPPRESS)  # one worker of a sweep
+    parser.add_argument("--worker", type=int, help=argparse.SUPPRESS)
+    parser.add_argument("--threads", type=int, default=0, help=argparse.SUPPRESS)
+    parser.add_argument("--interop-threads", type=int, default=0, help=argparse.SUPPRESS)
+    parser.add_argument("--cv2-threads", type=int, default=0, help=argparse.SUPPRESS)
+    parser.add_argument("--affinity", default="", help=argparse.SUPPRESS)
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    opt = parse_opt()
+    if opt.measure:
+        options = vars(opt)
+        for k in ("measure", "output"):
+            del options[k]
+        print(measure(**options))
+    else:
+        autotune(opt.workers, opt.seconds, opt.size, opt.batch, opt.output)
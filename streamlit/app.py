@@ -3,10 +3,9 @@ import pandas as pd
 from PIL import Image, ImageDraw, ImageFilter, ImageFont
 from pathlib import Path
 import os
-import io
 from io import StringIO, BytesIO
 import requests
-from helper import load_image, add_transparent_mask, combine_images, draw_rectangles
+from helper import load_image, add_transparent_mask, combine_images, render_overlay, apply_overlay, to_display_array, create_session, load_sample, shrink_image, count_curve, count_above
 
 # Set up the Streamlit page configuration
 st.set_page_config(page_title="SMART Gelose Counter", page_icon="👀", layout="wide")
@@ -34,7 +33,20 @@ COLOR_PALETTE = {
 # Get the path of the current script directory and the associated paths
 APP_DIRECTORY = Path(__file__).resolve().parent
 LOGO_PATH = APP_DIRECTORY.parent / "assets" / "SMART_Gelose.png"
-DATA_PATH = APP_DIRECTORY.parent / "assets" / "sample" / "Test_countings.csv"
+SAMPLE_PATH = APP_DIRECTORY.parent / "assets" / "sample"
+DATA_PATH = SAMPLE_PATH / "Test_countings.csv"
+
+# API client settings
+API_URL = os.getenv("API_URL", "https://ufc-counter-api-e72d4934bdd3.herokuapp.com")  # base URL of the FastAPI server
+API_TIMEOUT = (float(os.getenv("API_CONNECT_TIMEOUT", 5)), float(os.getenv("API_READ_TIMEOUT", 60)))  # (connect, read) timeouts (s)
+API_RETRIES = int(os.getenv("API_RETRIES", 3))  # retries of the failed connections and transient server errors
+PREFETCH_SAMPLES = os.getenv("PREFETCH_SAMPLES", "1") == "1"  # keep the sample images in memory
+UPLOAD_MAX_SIZE = int(os.getenv("UPLOAD_MAX_SIZE", 640))  # uploaded image size, the model inference size (0 for full resolution)
+UPLOAD_QUALITY = int(os.getenv("UPLOAD_QUALITY", 90))  # JPEG quality of the uploaded image
+CURVE_FLOOR = 0.05  # lowest confidence threshold of the count-vs-threshold curve
+
+# Maximum width and height of the displayed images, they are precomputed once per plate at this size
+DISPLAY_MAX_SIZE = 1600
 
 # Add the logo to the sidebar
 st.sidebar.image(str(LOGO_PATH), width=250)
@@ -59,12 +71,48 @@ st.sidebar.write("**Visualization Options**")
 # Sidebar toggle options
 activate_shutter_view = st.sidebar.toggle("Activate the shutter view", value=False)
 show_probabilities = st.sidebar.toggle("Show prediction probabilities", value=False)
+confidence_threshold = st.sidebar.slider("Confidence threshold", CURVE_FLOOR, 0.95, 0.25, 0.01)
 
 st.title("Prototype Demonstration 🦠🧫🔎")
 
+@st.cache_data(max_entries=32, show_spinner=False)
+def cached_overlay(size, results_data, show_probabilities):
+    """
+    Render the prediction overlay once per (image size, results, show_probabilities) key.
+
+    Args:
+        size (tuple): The (width, height) of the image.
+        results_data (pd.DataFrame): The prediction results containing bounding box coordinates.
+        show_probabilities (bool): Whether to display prediction probabilities.
+
+    Returns:
+        Image: The RGBA overlay layer.
+    """
+    return render_overlay(size, results_data, show_probabilities)
+
+@st.cache_resource
+def get_session():
+    """
+    Create the keep-alive HTTP session shared by every rerun and user session of the app.
+
+    Returns:
+        requests.Session: The pooled session, with retries.
+    """
+    return create_session(retries=API_RETRIES)
+
+@st.cache_resource
+def prefetch_samples():
+    """
+    Read the sample images once and keep them in memory.
+
+    Returns:
+        dict: The content of each sample image file, by name.
+    """
+    return {path.name: path.read_bytes() for path in sorted(SAMPLE_PATH.glob("*.jpg"))}
+
 def load_sample_image(selected_image):
     """
-    Load an image from a remote GitHub repository.
+    Load a sample image from the local sample library.
     
     Args:
         selected_image (str): Name of the image file to load.
@@ -72,16 +120,10 @@ def load_sample_image(selected_image):
     Returns:
         BytesIO: Image file in a BytesIO format.
     """
-    github_raw_url = "https://raw.githubusercontent.com/arnaud-dg/UFC-counter/main/assets/sample/"
-    image_url = github_raw_url + selected_image
-    
-    response = requests.get(image_url)
-    if response.status_code == 200:
-        img_file = BytesIO(response.content)
-        img_file.name = selected_image
-        return img_file
-    else:
-        st.error(f"Failed to load the image from GitHub. Status code: {response.status_code}")
+    try:
+        return load_sample(SAMPLE_PATH, selected_image, prefetch_samples() if PREFETCH_SAMPLES else None)
+    except OSError as e:
+        st.error(f"Failed to load the sample image: {e}")
         return None
 
 # Load the image based on user input or from sample library
@@ -94,6 +136,40 @@ if sample_library:
 else:
     uploaded_file = st.file_uploader("Please select your own new file through the browser of drag and drop it.", type=["jpg", "png", "jpeg"])
 
+@st.cache_data(ttl=3600, max_entries=64, show_spinner=False)
+def request_predictions(file_bytes):
+    """
+    Send an image to the FastAPI server, once per image content (the cache is keyed by a hash of the bytes).
+
+    The boxes are requested down to the CURVE_FLOOR confidence, so that any threshold of the slider is answered from
+    this single inference.
+
+    Args:
+        file_bytes (bytes): The content of the uploaded image file.
+
+    Returns:
+        pd.DataFrame: A DataFrame containing the prediction results.
+
+    Raises:
+        requests.HTTPError: If the API request failed, so that failures are not cached.
+        ValueError: If the API response cannot be parsed.
+    """
+    # Upload the image at the inference size of the model, the server maps the boxes back to the original size
+    img_bytes, scale = shrink_image(load_image(BytesIO(file_bytes)), UPLOAD_MAX_SIZE, UPLOAD_QUALITY)
+
+    # Request the compact columnar format, which maps directly to a DataFrame
+    response = get_session().post(f"{API_URL}/predict/", params={"format": "columns", "scale": scale, "conf": CURVE_FLOOR}, files={"file": img_bytes}, timeout=API_TIMEOUT)
+    response.raise_for_status()
+    content = response.json()
+    predictions = content["predictions"]
+    if isinstance(predictions, str):  # API version without the columnar format
+        results = pd.read_json(StringIO(predictions))
+    else:
+        results = pd.DataFrame(predictions)
+    if content.get("scale", 1.0) != scale and not results.empty:  # API version without the scale parameter
+        results[['xmin', 'ymin', 'xmax', 'ymax']] *= scale
+    return results
+
 def analyze_image(uploaded_file):
     """
     Analyze the uploaded image using the FastAPI server and return the prediction results.
@@ -106,32 +182,32 @@ def analyze_image(uploaded_file):
     """
     st.session_state['image'] = load_image(uploaded_file)
     st.session_state['image_name'] = uploaded_file.name
-    st.session_state['image_with_mask'] = add_transparent_mask(st.session_state['image'], 0.15)
+    st.session_state['image_with_mask'] = to_display_array(add_transparent_mask(st.session_state['image'], 0.15), DISPLAY_MAX_SIZE)
     
     with st.spinner("Processing..."):
-        img_byte_arr = io.BytesIO()
-        st.session_state['image'].save(img_byte_arr, format='JPEG')
-        img_byte_arr = img_byte_arr.getvalue()
-
-        response = requests.post("https://ufc-counter-api-e72d4934bdd3.herokuapp.com/predict/", files={"file": img_byte_arr})
-        
-        if response.status_code == 200:
-            try:
-                response_json = response.json()
-                return pd.read_json(StringIO(response_json["predictions"]))
-            except ValueError:
-                st.error("Error parsing JSON response from API")
-                st.write(response.text)
+        # Images analyzed before (same content) are served from the cache without calling the API
+        try:
+            results = request_predictions(uploaded_file.getvalue())
+        except requests.HTTPError as e:
+            st.error(f"API request failed with status code {e.response.status_code}")
+            st.write(e.response.text)
+        except requests.RequestException as e:
+            st.error(f"API request failed: {e}")
+        except ValueError:
+            st.error("Error parsing JSON response from API")
         else:
-            st.error(f"API request failed with status code {response.status_code}")
-            st.write(response.text)
+            # Any threshold is then answered from the count-vs-threshold curve, without a new inference
+            st.session_state['curve'] = count_curve(results['confidence'])
+            return results
 
 if uploaded_file is not None:
     if 'results' not in st.session_state or st.session_state['image_name'] != uploaded_file.name:
         st.session_state['results'] = analyze_image(uploaded_file)
 
-    # Display the number of detected objects
-    st.session_state['predicted_ufc_count'] = len(st.session_state['results'])  
+    # Display the number of detected objects above the confidence threshold, read from the curve
+    results = st.session_state['results']
+    results = results[results['confidence'] > confidence_threshold]
+    st.session_state['predicted_ufc_count'] = count_above(st.session_state['curve'], confidence_threshold)
     known_image = st.session_state['image_name'] in df['image_name'].unique()
     if known_image:
         st.session_state['real_ufc_count'] = df[df['image_name'] == st.session_state['image_name']]['result'].values[0]
@@ -140,17 +216,21 @@ if uploaded_file is not None:
     col1, col2 = st.columns([3, 1])
     
     with col1:
-        # Draw rectangles for each prediction
-        st.session_state['image_with_rectangles'] = draw_rectangles(st.session_state['image'].copy(), st.session_state['results'], show_probabilities)
+        # Draw rectangles for each prediction, once per plate and visualization option
+        rectangles_key = (st.session_state['image_name'], show_probabilities, confidence_threshold)
+        if st.session_state.get('rectangles_key') != rectangles_key:
+            overlay = cached_overlay(st.session_state['image'].size, results, show_probabilities)
+            st.session_state['image_with_rectangles'] = to_display_array(apply_overlay(st.session_state['image'], overlay), DISPLAY_MAX_SIZE)
+            st.session_state['rectangles_key'] = rectangles_key
         
         # Shutter view logic
         if activate_shutter_view:
             split_percentage = st.slider("Shutter parameter", 0, 100, 50, key="slider1", label_visibility='collapsed')
             combined_image = combine_images(st.session_state['image_with_mask'], st.session_state['image_with_rectangles'], split_percentage)
-            st.image(combined_image, caption='Prediction results', use_column_width=True)
+            st.image(combined_image, caption='Prediction results', use_column_width=True, output_format='JPEG')
         else:
             st.slider("Shutter parameter", 0, 100, 50, key="slider1", disabled=True, label_visibility='collapsed')
-            st.image(st.session_state['image_with_rectangles'], caption='Prediction results', use_column_width=True)
+            st.image(st.session_state['image_with_rectangles'], caption='Prediction results', use_column_width=True, output_format='JPEG')
 
     with col2:
         if uploaded_file is not None:
@@ -168,3 +248,7 @@ if uploaded_file is not None:
                     st.warning("Model is pretty close! (+/-5%)")
                 else:
                     st.error("It's not a match! Model must be optimized.")
+            if st.session_state.get('curve'):
+                with st.expander("Count vs. confidence threshold"):
+                    curve = st.session_state['curve']
+                    st.line_chart(pd.DataFrame({'threshold': curve['thresholds'], 'count': curve['counts']}), x='threshold', y='count')
@@ -1,5 +1,12 @@
 from PIL import Image, ImageDraw, ImageFont
+from functools import lru_cache
+import bisect
+from io import BytesIO
+import numpy as np
 import pandas as pd
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 def load_image(image_file):
     """
@@ -13,6 +20,99 @@ def load_image(image_file):
     """
     return Image.open(image_file)
 
+def create_session(retries=3, backoff_factor=0.5, pool_size=4):
+    """
+    Create a keep-alive HTTP session retrying the failed connections and the transient server errors.
+
+    Args:
+        retries (int): The maximum number of retries of a request.
+        backoff_factor (float): The base delay between two retries (seconds), doubled at each retry.
+        pool_size (int): The number of connections kept alive per host.
+
+    Returns:
+        requests.Session: The session, to be reused by every request.
+    """
+    retry = Retry(
+        total=retries,
+        backoff_factor=backoff_factor,
+        status_forcelist=(429, 502, 503, 504),
+        allowed_methods=None,  # predictions are idempotent, POST requests can be retried too
+        respect_retry_after_header=True,
+        raise_on_status=False,
+    )
+    adapter = HTTPAdapter(max_retries=retry, pool_connections=pool_size, pool_maxsize=pool_size)
+    session = requests.Session()
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+def load_sample(sample_dir, name, samples=None):
+    """
+    Load a sample image file from memory if it was prefetched, from the local sample directory otherwise.
+
+    Args:
+        sample_dir (Path): The directory of the sample images.
+        name (str): Name of the image file to load.
+        samples (dict, optional): The prefetched sample files, by name.
+
+    Returns:
+        BytesIO: Image file in a BytesIO format, named after the sample.
+    """
+    data = samples[name] if samples and name in samples else (sample_dir / name).read_bytes()
+    img_file = BytesIO(data)
+    img_file.name = name
+    return img_file
+
+def shrink_image(image, max_size=640, quality=90):
+    """
+    Downscale an image to the inference size of the model and encode it to JPEG for upload.
+
+    Args:
+        image (Image): The full-resolution image.
+        max_size (int): The maximum width and height of the uploaded image, 0 to keep the full resolution.
+        quality (int): The JPEG quality of the uploaded image.
+
+    Returns:
+        tuple: The JPEG bytes and the ratio of the original to the uploaded image size.
+    """
+    image = image.convert('RGB')
+    scale = 1.0
+    if max_size and max(image.size) > max_size:
+        ratio = max(image.size) / max_size
+        size = (max(1, round(image.width / ratio)), max(1, round(image.height / ratio)))
+        scale = image.width / size[0]  # exact ratio of the widths, used to map the boxes back
+        image = image.resize(size, Image.BILINEAR, reducing_gap=2.0)
+    buffer = BytesIO()
+    image.save(buffer, format='JPEG', quality=quality, optimize=True)
+    return buffer.getvalue(), scale
+
+def count_curve(confidences):
+    """
+    Compute the count-vs-threshold curve of the detections of one image.
+
+    Args:
+        confidences (iterable): The confidence of each detection.
+
+    Returns:
+        dict: The ascending "thresholds" (the confidences) and the number of detections at or above each ("counts").
+    """
+    thresholds = sorted(float(c) for c in confidences)
+    return {'thresholds': thresholds, 'counts': list(range(len(thresholds), 0, -1))}
+
+def count_above(curve, threshold):
+    """
+    Read the number of detections with a confidence above a threshold from a count-vs-threshold curve.
+
+    Args:
+        curve (dict): The curve, with the ascending "thresholds" and the "counts" at or above each.
+        threshold (float): The confidence threshold.
+
+    Returns:
+        int: The number of detections with a confidence above the threshold.
+    """
+    i = bisect.bisect_right(curve['thresholds'], threshold)
+    return curve['counts'][i] if i < len(curve['counts']) else 0
+
 def add_transparent_mask(image, transparency=0.15):
     """
     Add a white transparent mask to the image.
@@ -28,81 +128,154 @@ def add_transparent_mask(image, transparency=0.15):
     mask = Image.new('RGBA', (width, height), (255, 255, 255, int(255 * transparency)))
     return Image.alpha_composite(image.convert('RGBA'), mask)
 
+def to_display_array(image, max_size=1600):
+    """
+    Downscale an image to the display size and convert it to an RGB NumPy array.
+
+    Args:
+        image (Image): The image to convert.
+        max_size (int): The maximum width and height of the displayed image.
+
+    Returns:
+        np.ndarray: The (height, width, 3) RGB array.
+    """
+    image = image.convert('RGB')  # copy
+    image.thumbnail((max_size, max_size))
+    return np.asarray(image)
+
 def combine_images(image1, image2, split_percentage):
     """
     Combine two images by splitting them at a given percentage.
 
     Args:
-        image1 (Image): The first image.
-        image2 (Image): The second image.
+        image1 (np.ndarray): The first (height, width, 3) image.
+        image2 (np.ndarray): The second image, of the same shape.
         split_percentage (int): The percentage at which to split the images.
 
     Returns:
-        Image: The combined image.
+        np.ndarray: The combined image.
     """
     assert 0 <= split_percentage <= 100, "split_percentage must be between 0 and 100"
     
-    width, height = image1.size
-    split_position = int(width * split_percentage / 100)
-    
-    combined_image = Image.new('RGB', (width, height))
-    combined_image.paste(image1.crop((0, 0, split_position, height)), (0, 0))  # Add the first part of the image
-    combined_image.paste(image2.crop((split_position, 0, width, height)), (split_position, 0))  # Add the second part of the image
-    return combined_image
+    split_position = int(image1.shape[1] * split_percentage / 100)
+    return np.concatenate((image1[:, :split_position], image2[:, split_position:]), axis=1)  # column slices
 
-def draw_rectangles(image, results_data, show_probabilities=False):
+@lru_cache(maxsize=None)
+def load_font(font_size):
     """
-    Draw green rectangles on the image based on prediction results.
+    Load the label font and measure the size of a confidence label once per font size.
 
     Args:
-        image (Image): The image on which to draw.
+        font_size (int): The font size.
+
+    Returns:
+        tuple: The font and the (width, height) of a confidence label such as "99.99%".
+    """
+    try:
+        font = ImageFont.truetype("arial.ttf", font_size)
+    except IOError:
+        font = ImageFont.load_default()
+    text_bbox = ImageDraw.Draw(Image.new('RGBA', (1, 1))).textbbox((0, 0), "00.00%", font=font)
+    return font, (text_bbox[2] - text_bbox[0], text_bbox[3] - text_bbox[1])
+
+def coverage(boxes, width, height):
+    """
+    Count, in one vectorized pass, how many boxes cover each pixel of the image.
+
+    Args:
+        boxes (np.ndarray): The (n, 4) integer boxes (x0, y0, x1, y1), corners included.
+        width (int): The image width.
+        height (int): The image height.
+
+    Returns:
+        np.ndarray: The (height, width) number of boxes covering each pixel.
+    """
+    x0, y0 = np.clip(boxes[:, 0], 0, width), np.clip(boxes[:, 1], 0, height)
+    x1, y1 = np.clip(boxes[:, 2] + 1, 0, width), np.clip(boxes[:, 3] + 1, 0, height)
+    valid = (x1 > x0) & (y1 > y0)  # skip empty boxes
+    x0, y0, x1, y1 = x0[valid], y0[valid], x1[valid], y1[valid]
+
+    # 2D difference array: +1 at the top-left corner, -1 past the right and bottom edges, +1 past the bottom-right one
+    diff = np.zeros((height + 1, width + 1), dtype=np.int32)
+    np.add.at(diff, (y0, x0), 1)
+    np.add.at(diff, (y0, x1), -1)
+    np.add.at(diff, (y1, x0), -1)
+    np.add.at(diff, (y1, x1), 1)
+    np.cumsum(diff, axis=0, out=diff)
+    np.cumsum(diff, axis=1, out=diff)
+    return diff[:height, :width]
+
+def render_overlay(size, results_data, show_probabilities=False):
+    """
+    Render the prediction boxes (and optionally their probabilities) into a single transparent RGBA layer.
+
+    Args:
+        size (tuple): The (width, height) of the image.
         results_data (pd.DataFrame): The prediction results containing bounding box coordinates.
         show_probabilities (bool): Whether to display prediction probabilities.
 
     Returns:
-        Image: The image with rectangles drawn.
+        Image: The RGBA overlay layer.
     """
-    draw = ImageDraw.Draw(image, 'RGBA')
-    width, height = image.size
+    width, height = size
     
     # Calculate base size for text and rectangles, proportional to image dimensions
     base_size = int(min(width, height) * 0.02)  # 2% of the smaller dimension
     min_size = 14
     font_size = max(base_size, min_size)
     line_width = max(3, int(base_size * 0.3))
-    
-    try:
-        font = ImageFont.truetype("arial.ttf", font_size)
-    except IOError:
-        font = ImageFont.load_default()
 
-    for _, row in results_data.iterrows():
-        bbox = [row['xmin'], row['ymin'], row['xmax'], row['ymax']]
-        draw.rectangle(bbox, outline='green', fill=(0, 255, 0, 100), width=line_width)
-    
-    if show_probabilities:
-        for _, row in results_data.iterrows():
-            confidence = f"{row['confidence'] * 100:.2f}%"
-            text_position = (int(row['xmax']) + 2, int(row['ymin']))
-            
-            # Create a temporary image to measure text size
-            temp_img = Image.new('RGBA', (1, 1), (0, 0, 0, 0))
-            temp_draw = ImageDraw.Draw(temp_img)
-            text_bbox = temp_draw.textbbox((0, 0), confidence, font=font)
-            text_width = text_bbox[2] - text_bbox[0]
-            text_height = text_bbox[3] - text_bbox[1]
-            
-            # Add padding to the text background
-            padding = font_size // 2
-            text_bg = [text_position[0], text_position[1], 
-                       text_position[0] + text_width + padding * 2, 
-                       text_position[1] + text_height + padding * 2]
-            
-            # Draw white background for text
-            draw.rectangle(text_bg, fill='white')
-            
-            # Draw text in dark green
-            draw.text((text_position[0] + padding, text_position[1] + padding), 
-                      text=confidence, fill='darkgreen', font=font)
-
-    return image
+    overlay = np.zeros((height, width, 4), dtype=np.uint8)
+    boxes = results_data[['xmin', 'ymin', 'xmax', 'ymax']].to_numpy().astype(int).reshape(-1, 4)
+
+    # Green transparent fill inside the boxes and opaque outline of line_width pixels along their inner edges
+    covered = coverage(boxes, width, height)
+    outlined = covered - coverage(boxes + [line_width, line_width, -line_width, -line_width], width, height)
+    overlay[covered > 0] = (0, 255, 0, 100)
+    overlay[outlined > 0] = (0, 128, 0, 255)
+
+    if show_probabilities and len(boxes):
+        font, (text_width, text_height) = load_font(font_size)
+        padding = font_size // 2
+        text_positions = np.stack((boxes[:, 2] + 2, boxes[:, 1]), 1)
+
+        # Draw white backgrounds for the texts, with padding
+        text_size = [text_width + padding * 2 - 1, text_height + padding * 2 - 1]
+        text_bg = np.concatenate((text_positions, text_positions + text_size), 1)
+        overlay[coverage(text_bg, width, height) > 0] = (255, 255, 255, 255)
+
+        # Draw texts in dark green
+        overlay = Image.fromarray(overlay, 'RGBA')
+        draw = ImageDraw.Draw(overlay)
+        for (x, y), confidence in zip(text_positions.tolist(), results_data['confidence'].tolist()):
+            draw.text((x + padding, y + padding), text=f"{confidence * 100:.2f}%", fill='darkgreen', font=font)
+        return overlay
+
+    return Image.fromarray(overlay, 'RGBA')
+
+def apply_overlay(image, overlay):
+    """
+    Composite an RGBA overlay layer onto an image.
+
+    Args:
+        image (Image): The image on which to draw.
+        overlay (Image): The RGBA overlay layer of the same size.
+
+    Returns:
+        Image: The image with the overlay drawn.
+    """
+    return Image.alpha_composite(image.convert('RGBA'), overlay).convert('RGB')
+
+def draw_rectangles(image, results_data, show_probabilities=False):
+    """
+    Draw green rectangles on the image based on prediction results.
+
+    Args:
+        image (Image): The image on which to draw.
+        results_data (pd.DataFrame): The prediction results containing bounding box coordinates.
+        show_probabilities (bool): Whether to display prediction probabilities.
+
+    Returns:
+        Image: The image with rectangles drawn.
+    """
+    return apply_overlay(image, render_overlay(image.size, results_data, show_probabilities))
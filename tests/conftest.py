@@ -0,0 +1,7 @@
+import sys
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parents[1]
+for path in (ROOT, ROOT / "yolov5"):  # the api package and the YOLOv5 top-level modules (models, utils)
+    if str(path) not in sys.path:
+        sys.path.insert(0, str(path))
@@ -0,0 +1,72 @@
+"""AutoShape wrapper and its reusable input buffers."""
+
+import copy
+import pickle
+
+import cv2
+import numpy as np
+import pytest
+import torch
+
+from models.common import AutoShape, Counts
+from models.yolo import DetectionModel
+from utils.augmentations import InputBuffers, letterbox
+from utils.general import ROOT, Profile
+
+
+@pytest.fixture(scope="module")
+def model():
+    """Single-class YOLOv5n AutoShape with random weights."""
+    return AutoShape(DetectionModel(ROOT / "models" / "yolov5n.yaml", nc=1), verbose=False)
+
+
+def letterbox_reference(im, shape, color=(114, 114, 114)):
+    """The former letterbox, a resize then a copyMakeBorder."""
+    r = min(shape[0] / im.shape[0], shape[1] / im.shape[1])
+    w, h = int(round(im.shape[1] * r)), int(round(im.shape[0] * r))
+    dw, dh = (shape[1] - w) / 2, (shape[0] - h) / 2
+    if im.shape[1::-1] != (w, h):
+        im = cv2.resize(im, (w, h), interpolation=cv2.INTER_LINEAR)
+    top, bottom, left, right = (int(round(dh - 0.1)), int(round(dh + 0.1)), int(round(dw - 0.1)), int(round(dw + 0.1)))
+    return cv2.copyMakeBorder(im, top, bottom, left, right, cv2.BORDER_CONSTANT, value=color)
+
+
+def test_module_methods(model):
+    """The input buffers do not hide nn.Module.buffers()."""
+    assert isinstance(model.inputs, InputBuffers)
+    assert all(isinstance(b, torch.Tensor) for b in model.buffers())
+
+
+def test_copy(model):
+    """AutoShape can be deep-copied and pickled, the copies get their own empty input buffers."""
+    im = np.random.default_rng(0).integers(0, 255, (200, 300, 3), dtype=np.uint8)
+    model(im, size=128)  # fill the input buffers of this thread
+    for m in (copy.deepcopy(model), pickle.loads(pickle.dumps(model))):
+        assert m.inputs is not model.inputs
+        assert getattr(m.inputs.local, "cache", None) is None
+        assert len(m(im, size=128).pred) == 1
+
+
+@pytest.mark.parametrize("shape", [(480, 640), (640, 480), (640, 640), (300, 200)])
+def test_letterbox(shape):
+    """The fused letterbox and the buffered preprocessing match the former resize + pad + stack + scale."""
+    rng = np.random.default_rng(0)
+    ims = [rng.integers(0, 255, (*s, 3), dtype=np.uint8) for s in (shape, shape[::-1], (100, 100))]
+    new_shape = (320, 320)
+    expected = [letterbox_reference(im, new_shape) for im in ims]
+    for im, e in zip(ims, expected):
+        assert np.array_equal(letterbox(im, new_shape, auto=False)[0], e)
+    x = torch.from_numpy(np.ascontiguousarray(np.array(expected).transpose((0, 3, 1, 2)))).float() / 255
+    buffers = InputBuffers()
+    for _ in range(2):  # the second call reuses the buffers
+        assert torch.allclose(buffers.letterbox(ims, new_shape), x, atol=1e-6)
+
+
+def test_counts_histogram():
+    """The confidence histogram only bins the counted detections, none above a threshold of 1."""
+    pred = [torch.tensor([[0, 0, 10, 10, c, 0] for c in (0.3, 0.6, 0.9, 1.0)])]
+    counts = Counts(pred, ["image0.jpg"], (Profile(), Profile(), Profile()), {0: "cfu"}, (1, 3, 64, 64))
+    edges, hist = counts.histogram(bins=2, conf=0.5)
+    assert edges == pytest.approx([0.5, 0.75, 1.0]) and hist == [[1, 2]]
+    assert counts.count(1.0) == [0]
+    assert counts.histogram(bins=3, conf=1.0) == ([1.0] * 4, [[0, 0, 0]])
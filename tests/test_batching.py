@@ -0,0 +1,104 @@
+"""Micro-batching scheduler of the API."""
+
+import asyncio
+import threading
+import time
+
+import pytest
+
+from api.batching import MicroBatcher, QueueFullError, UnavailableError
+
+
+class Results:
+    """Stand-in for the detections of a batch, split per image by tolist()."""
+
+    def __init__(self, images):
+        self.images = images
+
+    def tolist(self):
+        return list(self.images)
+
+
+class Model:
+    """Stand-in for the model, records its calls and blocks until released (or sleeps `delay` seconds)."""
+
+    def __init__(self, delay=0.0, block=False):
+        self.delay = delay
+        self.released = threading.Event()
+        if not block:
+            self.released.set()
+        self.calls = []
+
+    def __call__(self, images, **options):
+        self.calls.append((images, options))
+        self.released.wait(5)
+        time.sleep(self.delay)
+        return Results(images)
+
+
+def test_batches_requests():
+    """Concurrent requests run as one forward pass, the per-image options as per-image lists."""
+
+    async def main():
+        model = Model()
+        batcher = MicroBatcher(model, window_ms=50)
+        await batcher.start()
+        results = await asyncio.gather(batcher.submit("a", conf=0.5), batcher.submit_many(["b", "c"]))
+        await batcher.stop()
+        return model, results
+
+    model, results = asyncio.run(main())
+    assert results == ["a", ["b", "c"]]
+    assert model.calls == [(["a", "b", "c"], {"conf": [0.5, None, None]})]
+
+
+def test_queue_full():
+    """A request is rejected at once when the queue has not enough free slots."""
+
+    async def main():
+        model = Model(block=True)
+        batcher = MicroBatcher(model, max_batch_size=1, window_ms=0, max_queue_size=2, timeout=5)
+        await batcher.start()
+        running = asyncio.ensure_future(batcher.submit("a"))  # blocks the inference thread
+        await asyncio.sleep(0.05)
+        queued = [asyncio.ensure_future(batcher.submit(x)) for x in "bc"]  # fills the queue
+        await asyncio.sleep(0.05)
+        with pytest.raises(QueueFullError):
+            await batcher.submit("d")
+        with pytest.raises(QueueFullError):
+            await batcher.submit_many(["d", "e"])
+        model.released.set()
+        results = await asyncio.gather(running, *queued)
+        await batcher.stop()
+        return results
+
+    assert asyncio.run(main()) == ["a", "b", "c"]
+
+
+def test_timeout():
+    """A request waiting longer than the timeout fails with UnavailableError."""
+
+    async def main():
+        batcher = MicroBatcher(Model(delay=0.5), timeout=0.05)
+        await batcher.start()
+        with pytest.raises(UnavailableError):
+            await batcher.submit("a")
+        await batcher.stop()
+
+    asyncio.run(main())
+
+
+def test_not_running():
+    """Requests are rejected before start() and after stop()."""
+
+    async def main():
+        batcher = MicroBatcher(Model())
+        with pytest.raises(UnavailableError):
+            await batcher.submit("a")
+        await batcher.start()
+        assert await batcher.submit("a") == "a"
+        await batcher.stop()
+        with pytest.raises(UnavailableError):
+            await batcher.submit("a")
+
+    asyncio.run(main())
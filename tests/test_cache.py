@@ -0,0 +1,74 @@
+"""Result cache of the API."""
+
+import pytest
+
+from api import cache as cache_module
+from api.cache import ResultCache, cache_key
+
+
+class Clock:
+    """Stand-in for the time module of the cache, advanced by hand."""
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def time(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(cache_module, "time", clock)
+    return clock
+
+
+def test_hit():
+    """A stored value is served back, the keys depend on the settings."""
+    cache = ResultCache()
+    key = cache_key(b"image", "v1", 0.25)
+    assert cache.get(key) is None
+    cache.set(key, ([1, 2], 640))
+    assert cache.get(key) == ([1, 2], 640)
+    assert cache.get(cache_key(b"image", "v1", 0.5)) is None
+
+
+def test_ttl(clock):
+    """An entry expires after its time to live."""
+    cache = ResultCache(ttl=10)
+    cache.set("a", 1)
+    clock.now += 9
+    assert cache.get("a") == 1
+    clock.now += 2
+    assert cache.get("a") is None
+    assert "a" not in cache.entries
+
+
+def test_lru_eviction():
+    """Beyond max_entries, the least recently used entry is evicted."""
+    cache = ResultCache(max_entries=2)
+    cache.set("a", 1)
+    cache.set("b", 2)
+    assert cache.get("a") == 1  # b is now the least recently used
+    cache.set("c", 3)
+    assert cache.get("b") is None
+    assert cache.get("a") == 1
+    assert cache.get("c") == 3
+
+
+def test_disabled():
+    """With max_entries=0, nothing is stored."""
+    cache = ResultCache(max_entries=0)
+    cache.set("a", 1)
+    assert cache.get("a") is None
+
+
+def test_sqlite(tmp_path, clock):
+    """The on-disk tier is shared by the instances of the same file and honours the TTL."""
+    path = str(tmp_path / "cache.db")
+    ResultCache(ttl=10, path=path).set("a", {"count": 3})
+    cache = ResultCache(ttl=10, path=path)
+    assert cache.get("a") == {"count": 3}
+    assert "a" in cache.entries  # promoted to memory
+    clock.now += 11
+    assert ResultCache(ttl=10, path=path).get("a") is None
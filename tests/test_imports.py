@@ -0,0 +1,37 @@
+"""Import-time budget of the inference path (`models.common`, `models.yolo`) served by the API."""
+
+import subprocess
+import sys
+from pathlib import Path
+
+YOLO_PATH = Path(__file__).resolve().parents[1] / "yolov5"
+IMPORT_BUDGET = 2.0  # seconds on top of torch, torchvision, cv2 and numpy
+HEAVY_MODULES = ("pandas", "matplotlib", "ultralytics", "requests")
+
+CODE = f"""
+import cv2, numpy, torch, torchvision
+import models.common, models.yolo
+import sys
+print(",".join(m for m in {HEAVY_MODULES!r} if m in sys.modules))
+"""
+
+
+def import_inference_path():
+    """Import the inference modules in a fresh interpreter, return the loaded heavy modules and the import time."""
+    p = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", CODE], cwd=YOLO_PATH, capture_output=True, text=True, check=True
+    )
+    seconds = 0.0
+    for line in p.stderr.splitlines():  # "import time: self [us] | cumulative | imported package"
+        fields = line.split("|")
+        if len(fields) == 3 and fields[2].rstrip() in (" models.common", " models.yolo"):  # top-level imports only
+            seconds += int(fields[1]) / 1e6
+    loaded = [m for m in p.stdout.strip().split(",") if m]
+    return loaded, seconds
+
+
+def test_inference_imports():
+    """The inference path loads no plotting, dataframe or network dependency and imports within the budget."""
+    loaded, seconds = import_inference_path()
+    assert not loaded, f"inference path imports {loaded}"
+    assert 0 < seconds < IMPORT_BUDGET, f"inference path imported in {seconds:.2f}s, budget {IMPORT_BUDGET}s"
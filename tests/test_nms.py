@@ -0,0 +1,71 @@
+"""Batched non-maximum suppression against the reference per-image loop."""
+
+import pytest
+import torch
+import torchvision
+
+from utils.general import non_max_suppression, xywh2xyxy
+
+
+def reference_nms(
+    prediction, conf_thres=0.25, iou_thres=0.45, classes=None, agnostic=False, multi_label=False, max_det=300
+):
+    """The per-image NMS loop of upstream YOLOv5, without the time limit."""
+    nc = prediction.shape[2] - 5  # number of classes
+    multi_label &= nc > 1
+    output = [torch.zeros((0, 6))] * prediction.shape[0]
+    for xi, x in enumerate(prediction):
+        x = x[x[:, 4] > conf_thres].clone()
+        if not len(x):
+            continue
+        x[:, 5:] *= x[:, 4:5]  # conf = obj_conf * cls_conf
+        box = xywh2xyxy(x[:, :4])
+        if multi_label:
+            i, j = (x[:, 5:] > conf_thres).nonzero(as_tuple=False).T
+            x = torch.cat((box[i], x[i, 5 + j, None], j[:, None].float()), 1)
+        else:
+            conf, j = x[:, 5:].max(1, keepdim=True)
+            x = torch.cat((box, conf, j.float()), 1)[conf.view(-1) > conf_thres]
+        if classes is not None:
+            x = x[(x[:, 5:6] == torch.tensor(classes)).any(1)]
+        if not len(x):
+            continue
+        x = x[x[:, 4].argsort(descending=True)[:30000]]
+        c = x[:, 5:6] * (0 if agnostic else 7680)  # class offsets
+        i = torchvision.ops.nms(x[:, :4] + c, x[:, 4], iou_thres)[:max_det]
+        output[xi] = x[i]
+    return output
+
+
+def random_prediction(bs, n, nc, seed=0):
+    """Random raw predictions (bs, n, 5 + nc) of boxes clustered on a few objects, so that NMS suppresses."""
+    g = torch.Generator().manual_seed(seed)
+    centers = torch.rand(bs, 20, 2, generator=g) * 600 + 20
+    xy = centers[:, torch.randint(0, 20, (n,), generator=g)] + torch.randn(bs, n, 2, generator=g) * 4
+    wh = torch.rand(bs, n, 2, generator=g) * 20 + 20
+    scores = torch.rand(bs, n, 1 + nc, generator=g)  # distinct scores, no ties in the NMS order
+    return torch.cat((xy, wh, scores), 2)
+
+
+@pytest.mark.parametrize(
+    "bs, n, nc, kwargs",
+    [
+        (4, 500, 1, {}),
+        (4, 500, 3, {}),
+        (4, 500, 3, {"multi_label": True}),
+        (4, 500, 3, {"agnostic": True}),
+        (4, 500, 3, {"classes": [0, 2]}),
+        (2, 500, 80, {"conf_thres": 0.01, "max_det": 20}),
+        (2, 4000, 1, {"conf_thres": 0.01}),  # above the single NMS call threshold, per-image NMS
+        (3, 500, 1, {"conf_thres": 0.999}),  # images without any candidate
+    ],
+)
+def test_matches_reference(bs, n, nc, kwargs):
+    """The vectorised NMS keeps the same detections, in the same order, as the per-image loop."""
+    prediction = random_prediction(bs, n, nc)
+    y = non_max_suppression(prediction.clone(), time_limit=0, **kwargs)
+    ref = reference_nms(prediction.clone(), **kwargs)
+    assert len(y) == len(ref)
+    for a, b in zip(y, ref):
+        assert a.shape == b.shape
+        torch.testing.assert_close(a, b)
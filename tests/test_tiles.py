@@ -0,0 +1,43 @@
+"""Merge of the detections of overlapping tiles."""
+
+import pytest
+import torch
+
+from utils.general import merge_tiles
+
+WINDOWS = [(0, 0, 640, 640), (512, 0, 1152, 640)]  # two tiles side by side, overlapping on x in [512, 640]
+
+
+def tile_preds(boxes):
+    """Builds the (n,6) per-tile detections of image-space boxes (tile, x1, y1, x2, y2, conf)."""
+    pred = [torch.zeros((0, 6)) for _ in WINDOWS]
+    for t, *box, conf in boxes:
+        x1, y1, *_ = WINDOWS[t]
+        d = torch.tensor([[box[0] - x1, box[1] - y1, box[2] - x1, box[3] - y1, conf, 0]])
+        pred[t] = torch.cat((pred[t], d))
+    return pred
+
+
+@pytest.mark.parametrize("method", ["nms", "wbf"])
+def test_straddling_colony(method):
+    """A colony cut by the right border of the first tile is merged with its complete box from the second tile."""
+    pred = tile_preds([(0, 630, 300, 640, 340, 0.6), (1, 630, 300, 670, 340, 0.9)])  # IoU 0.25, cut box inside
+    x = merge_tiles(pred, WINDOWS, method=method)
+    assert len(x) == 1
+    assert x[0, 2] > 650  # led by the complete box, not the cut one
+
+
+def test_touching_colonies():
+    """A small colony touching a larger one in the overlap is kept, as it would be away from a seam."""
+    large, small = (560, 100, 600, 140), (592, 120, 604, 132)  # small box 2/3 inside the large one, IoU 0.06
+    pred = tile_preds([(0, *large, 0.9), (0, *small, 0.8), (1, *large, 0.85), (1, *small, 0.75)])
+    x = merge_tiles(pred, WINDOWS)
+    assert len(x) == 2
+    assert sorted(x[:, 4].tolist()) == pytest.approx([0.8, 0.9])
+
+
+def test_duplicates_in_overlap():
+    """The same colony seen by both tiles is kept once, the most confident detection."""
+    pred = tile_preds([(0, 560, 200, 580, 220, 0.7), (1, 561, 201, 581, 221, 0.8), (1, 900, 200, 920, 220, 0.5)])
+    x = merge_tiles(pred, WINDOWS)
+    assert sorted(x[:, 4].tolist()) == pytest.approx([0.5, 0.8])
@@ -39,6 +39,7 @@ import pathlib
 temp = pathlib.PosixPath
 pathlib.PosixPath = pathlib.WindowsPath
 
+import numpy as np
 import torch
 
 FILE = Path(__file__).resolve()
@@ -61,10 +62,13 @@ from utils.general import (
     colorstr,
     cv2,
     increment_path,
+    merge_tiles,
     non_max_suppression,
     print_args,
     scale_boxes,
     strip_optimizer,
+    tile_images,
+    tile_windows,
     xyxy2xywh,
 )
 from utils.torch_utils import select_device, smart_inference_mode
@@ -100,6 +104,9 @@ def run(
     half=False,  # use FP16 half-precision inference
     dnn=False,  # use OpenCV DNN for ONNX inference
     vid_stride=1,  # video frame-rate stride
+    tile=0,  # sliced inference tile size (pixels), 0 to disable
+    tile_overlap=0.2,  # overlap between two tiles (fraction of the tile size)
+    tile_merge="nms",  # merge of the detections across tile seams, 'nms' or 'wbf'
 ):
     """
     Runs YOLOv5 detection inference on various sources like images, videos, directories, streams, etc.
@@ -136,6 +143,11 @@ def run(
         half (bool): If True, use FP16 half-precision inference. Default is False.
         dnn (bool): If True, use OpenCV DNN backend for ONNX inference. Default is False.
         vid_stride (int): Stride for processing video frames, to skip frames between processing. Default is 1.
+        tile (int): Tile size of the sliced inference at native resolution, for dense images of small objects. The
+            overlapping tiles of an image run as one batch. Default is 0 (disabled).
+        tile_overlap (float): Overlap between two tiles, as a fraction of the tile size. Default is 0.2.
+        tile_merge (str): Merge of the detections across tile seams, 'nms' or 'wbf' (weighted box fusion). Default is
+            'nms'.
 
     Returns:
         None
@@ -169,6 +181,7 @@ def run(
     model = DetectMultiBackend(weights, device=device, dnn=dnn, data=data, fp16=half)
     stride, names, pt = model.stride, model.names, model.pt
     imgsz = check_img_size(imgsz, s=stride)  # check image size
+    tile = check_img_size(tile, s=stride) if tile else 0  # check tile size
 
     # Dataloader
     bs = 1  # batch_size
@@ -187,6 +200,10 @@ def run(
     seen, windows, dt = 0, [], (Profile(device=device), Profile(device=device), Profile(device=device))
     for path, im, im0s, vid_cap, s in dataset:
         with dt[0]:
+            if tile:  # sliced inference, the tiles are cropped from the original BGR images at native resolution
+                tiles = [tile_windows(im0.shape, tile, tile_overlap) for im0 in (im0s if webcam else [im0s])]
+                im = np.concatenate([tile_images(im0, w, tile) for im0, w in zip(im0s if webcam else [im0s], tiles)])
+                im = np.ascontiguousarray(im.transpose((0, 3, 1, 2))[:, ::-1])  # BHWC to BCHW, BGR to RGB
             im = torch.from_numpy(im).to(model.device)
             im = im.half() if model.fp16 else im.float()  # uint8 to fp16/32
             im /= 255  # 0 - 255 to 0.0 - 1.0
@@ -211,6 +228,12 @@ def run(
         # NMS
         with dt[2]:
             pred = non_max_suppression(pred, conf_thres, iou_thres, classes, agnostic_nms, max_det=max_det)
+            if tile:  # shift the detections of the tiles to image coordinates and merge them per image
+                j = np.cumsum([0] + [len(w) for w in tiles])
+                pred = [
+                    merge_tiles(pred[j[i] : j[i + 1]], w, iou_thres, agnostic_nms, tile_merge)
+                    for i, w in enumerate(tiles)
+                ]
 
         # Second-stage classifier (optional)
         # pred = utils.general.apply_classifier(pred, classifier_model, im, im0s)
@@ -245,8 +268,8 @@ def run(
             imc = im0.copy() if save_crop else im0  # for save_crop
             annotator = Annotator(im0, line_width=line_thickness, example=str(names))
             if len(det):
-                # Rescale boxes from img_size to im0 size
-                det[:, :4] = scale_boxes(im.shape[2:], det[:, :4], im0.shape).round()
+                # Rescale boxes from img_size to im0 size (tiled detections are already in im0 coordinates)
+                det[:, :4] = det[:, :4].round() if tile else scale_boxes(im.shape[2:], det[:, :4], im0.shape).round()
 
                 # Print results
                 for c in det[:, 5].unique():
@@ -352,6 +375,9 @@ def parse_opt():
         --dnn (bool, optional): Flag to use OpenCV DNN for ONNX inference. Defaults to False.
         --vid-stride (int, optional): Video frame-rate stride, determining the number of frames to skip in between
             consecutive frames. Defaults to 1.
+        --tile (int, optional): Tile size of the sliced inference at native resolution, 0 to disable. Defaults to 0.
+        --tile-overlap (float, optional): Overlap between two tiles, as a fraction of the tile size. Defaults to 0.2.
+        --tile-merge (str, optional): Merge of the detections across tile seams, 'nms' or 'wbf'. Defaults to 'nms'.
 
     Returns:
         argparse.Namespace: Parsed command-line arguments as an argparse.Namespace object.
@@ -391,6 +417,9 @@ def parse_opt():
     parser.add_argument("--half", action="store_true", help="use FP16 half-precision inference")
     parser.add_argument("--dnn", action="store_true", help="use OpenCV DNN for ONNX inference")
     parser.add_argument("--vid-stride", type=int, default=1, help="video frame-rate stride")
+    parser.add_argument("--tile", type=int, default=0, help="sliced inference tile size (pixels), 0 to disable")
+    parser.add_argument("--tile-overlap", type=float, default=0.2, help="overlap between two tiles (fraction)")
+    parser.add_argument("--tile-merge", default="nms", choices=["nms", "wbf"], help="merge of the tiled detections")
     opt = parser.parse_args()
     opt.imgsz *= 2 if len(opt.imgsz) == 1 else 1  # expand
     print_args(vars(opt))
@@ -10,46 +10,39 @@ import warnings
 import zipfile
 from collections import OrderedDict, namedtuple
 from copy import copy
+from functools import cached_property
 from pathlib import Path
 from urllib.parse import urlparse
 
 import cv2
 import numpy as np
-import pandas as pd
-import requests
 import torch
 import torch.nn as nn
 from PIL import Image
 from torch.cuda import amp
 
-# Import 'ultralytics' package or install if missing
-try:
-    import ultralytics
-
-    assert hasattr(ultralytics, "__version__")  # verify package is not directory
-except (ImportError, AssertionError):
-    import os
-
-    os.system("pip install -U ultralytics")
-    import ultralytics
-
-from ultralytics.utils.plotting import Annotator, colors, save_one_box
-
 from utils import TryExcept
-from utils.dataloaders import exif_transpose, letterbox
+from utils.augmentations import InputBuffers, exif_transpose
 from utils.general import (
     LOGGER,
     ROOT,
     Profile,
+    batched_nms,
     check_requirements,
+    check_ultralytics,
     check_suffix,
     check_version,
     colorstr,
+    dish_window,
+    find_dish,
+    in_dish,
     increment_path,
     is_jupyter,
     make_divisible,
+    merge_tiles,
     non_max_suppression,
     scale_boxes,
+    tile_windows,
     xywh2xyxy,
     xyxy2xywh,
     yaml_load,
@@ -786,6 +779,10 @@ class AutoShape(nn.Module):
     classes = None  # (optional list) filter by class, i.e. = [0, 15, 16] for COCO persons, cats and dogs
     max_det = 1000  # maximum number of detections per image
     amp = False  # Automatic Mixed Precision (AMP) inference
+    adaptive_sizes = (320, 640, 1280)  # adaptive inference sizes, from the quick pass to the largest
+    adaptive_min_box = 12  # minimum median box size at inference (pixels), smaller objects are re-run larger
+    adaptive_crowd = 150  # number of quick-pass detections above which an image is crowded and re-run larger
+    sparse = False  # decode only the anchors above the confidence threshold (single-class PyTorch models)
 
     def __init__(self, model, verbose=True):
         """Initializes YOLOv5 model for inference, setting up attributes and preparing model for evaluation."""
@@ -796,10 +793,12 @@ class AutoShape(nn.Module):
         self.dmb = isinstance(model, DetectMultiBackend)  # DetectMultiBackend() instance
         self.pt = not self.dmb or model.pt  # PyTorch model
         self.model = model.eval()
+        self.inputs = InputBuffers(pin=True)  # reused input buffers, pinned if CUDA is available
         if self.pt:
             m = self.model.model.model[-1] if self.dmb else self.model.model[-1]  # Detect()
             m.inplace = False  # Detect.inplace=False for safe multithread inference
             m.export = True  # do not output loss values
+            self.sparse = hasattr(m, "forward_sparse") and m.nc == 1 and m.no == 6  # single-class Detect head
 
     def _apply(self, fn):
         """
@@ -817,11 +816,36 @@ class AutoShape(nn.Module):
         return self
 
     @smart_inference_mode()
-    def forward(self, ims, size=640, augment=False, profile=False):
+    def forward(
+        self,
+        ims,
+        size=640,
+        augment=False,
+        profile=False,
+        count=False,
+        tile=0,
+        overlap=0.2,
+        merge="nms",
+        roi=False,
+        adaptive=False,
+        conf=None,
+        iou=None,
+        max_det=None,
+    ):
         """
         Performs inference on inputs with optional augment & profiling.
 
-        Supports various formats including file, URI, OpenCV, PIL, numpy, torch.
+        Supports various formats including file, URI, OpenCV, PIL, numpy, torch. With `count=True`, returns lightweight
+        Counts instead of Detections, skipping the per-box formats for callers that only need the number of objects.
+        With `tile`, runs sliced inference: each image is split at native resolution into overlapping tile x tile crops
+        (`overlap` fraction), all the tiles run as one batch and their detections are merged across the tile seams with
+        `merge` ('nms' or 'wbf'), for dense images of small objects. With `roi`, each image is cropped to its Petri dish
+        before inference and the detections outside the dish are dropped. With `adaptive`, the inference size of each
+        image is chosen from a quick low-resolution pass (see `adaptive_forward()`), `size` is then ignored.
+
+        `conf`, `iou` and `max_det` override the NMS settings of this call only, without mutating the shared model (safe
+        for concurrent callers). Each is a value for all the images or a per-image list (None items for the defaults):
+        images with different settings share the forward pass, only NMS is split.
         """
         # For size(height=640, width=1280), RGB images example inputs are:
         #   file:        ims = 'data/images/zidane.jpg'  # str or PosixPath
@@ -832,6 +856,10 @@ class AutoShape(nn.Module):
         #   torch:           = torch.zeros(16,3,320,640)  # BCHW (scaled to size=640, 0-1 values)
         #   multiple:        = [Image.open('image1.jpg'), Image.open('image2.jpg'), ...]  # list of images
 
+        if adaptive and not tile and not isinstance(ims, torch.Tensor):
+            kwargs = {"overlap": overlap, "merge": merge, "roi": roi, "conf": conf, "iou": iou, "max_det": max_det}
+            return self.adaptive_forward(ims, augment=augment, count=count, **kwargs)
+
         dt = (Profile(), Profile(), Profile())
         with dt[0]:
             if isinstance(size, int):  # expand
@@ -844,10 +872,14 @@ class AutoShape(nn.Module):
 
             # Pre-process
             n, ims = (len(ims), list(ims)) if isinstance(ims, (list, tuple)) else (1, [ims])  # number, list of images
-            shape0, shape1, files = [], [], []  # image and inference shapes, filenames
+            shape0, shape1, files = [], [], []  # image (or dish crop) and inference shapes, filenames
+            crops, dishes = [None] * n, [None] * n  # inference inputs, dish circles
             for i, im in enumerate(ims):
                 f = f"image{i}"  # filename
                 if isinstance(im, (str, Path)):  # filename or uri
+                    if str(im).startswith("http"):
+                        import requests
+
                     im, f = Image.open(requests.get(im, stream=True).raw if str(im).startswith("http") else im), im
                     im = np.asarray(exif_transpose(im))
                 elif isinstance(im, Image.Image):  # PIL Image
@@ -856,60 +888,182 @@ class AutoShape(nn.Module):
                 if im.shape[0] < 5:  # image in CHW
                     im = im.transpose((1, 2, 0))  # reverse dataloader .transpose(2, 0, 1)
                 im = im[..., :3] if im.ndim == 3 else cv2.cvtColor(im, cv2.COLOR_GRAY2BGR)  # enforce 3ch input
-                s = im.shape[:2]  # HWC
+                ims[i] = crops[i] = im if im.data.contiguous else np.ascontiguousarray(im)  # update
+                if roi:  # crop to the dish bounding square
+                    dishes[i] = find_dish(im)
+                    if dishes[i] is not None:
+                        x1, y1, x2, y2 = dish_window(dishes[i], im.shape)
+                        crops[i] = np.ascontiguousarray(im[y1:y2, x1:x2])
+                s = crops[i].shape[:2]  # HWC
                 shape0.append(s)  # image shape
                 g = max(size) / max(s)  # gain
                 shape1.append([int(y * g) for y in s])
-                ims[i] = im if im.data.contiguous else np.ascontiguousarray(im)  # update
-            shape1 = [make_divisible(x, self.stride) for x in np.array(shape1).max(0)]  # inf shape
-            x = [letterbox(im, shape1, auto=False)[0] for im in ims]  # pad
-            x = np.ascontiguousarray(np.array(x).transpose((0, 3, 1, 2)))  # stack and BHWC to BCHW
-            x = torch.from_numpy(x).to(p.device).type_as(p) / 255  # uint8 to fp16/32
+            conf, iou, max_det = (
+                self._per_image(v, d, n) for v, d in ((conf, self.conf), (iou, self.iou), (max_det, self.max_det))
+            )  # NMS settings of each image
+            settings = list(zip(conf, iou, max_det))  # NMS settings of each batch row
+            if tile:  # sliced inference at native resolution
+                tile = make_divisible(tile, self.stride)
+                windows = [tile_windows(s, tile, overlap) for s in shape0]
+                x = self.inputs.tiles(crops, windows, tile)  # all tiles, BCHW 0.0-1.0
+                settings = [s for s, w in zip(settings, windows) for _ in w]
+            else:
+                shape1 = [make_divisible(x, self.stride) for x in np.array(shape1).max(0)]  # inf shape
+                x = self.inputs.letterbox(crops, shape1)  # pad, BCHW 0.0-1.0
+            x = x.to(p.device, non_blocking=True).type_as(p)  # fp16/32
 
         with amp.autocast(autocast):
             # Inference
+            sparse = self.sparse and not augment
             with dt[1]:
-                y = self.model(x, augment=augment)  # forward
+                if sparse:  # single-class head, only the anchors above the confidence threshold are decoded
+                    y = (self.model.model if self.dmb else self.model).forward_sparse(x, min(conf))
+                else:
+                    y = self.model(x, augment=augment)  # forward
 
             # Post-process
             with dt[2]:
-                y = non_max_suppression(
-                    y if self.dmb else y[0],
-                    self.conf,
-                    self.iou,
-                    self.classes,
-                    self.agnostic,
-                    self.multi_label,
-                    max_det=self.max_det,
-                )  # NMS
-                for i in range(n):
-                    scale_boxes(shape1, y[i][:, :4], shape0[i])
+                y = self._nms(y if sparse or self.dmb else y[0], settings, sparse)  # NMS
+                if tile:  # merge the tiles of each image
+                    j = np.cumsum([0] + [len(w) for w in windows])
+                    y = [merge_tiles(y[j[i] : j[i + 1]], windows[i], iou[i], self.agnostic, merge) for i in range(n)]
+                else:
+                    for i in range(n):
+                        scale_boxes(shape1, y[i][:, :4], shape0[i])
+                for i, dish in enumerate(dishes):
+                    if dish is not None:  # dish crop to image coordinates, drop the detections outside the dish
+                        x1, y1, *_ = dish_window(dish, ims[i].shape)
+                        y[i][:, [0, 2]] += x1
+                        y[i][:, [1, 3]] += y1
+                        y[i] = y[i][in_dish(y[i], dish)]
+
+            sizes = [max(s) for s in shape0] if tile else [max(shape1)] * n  # inference resolution of each image
+            if count:
+                return Counts(y, files, dt, self.names, x.shape, sizes, shape0)
+            return Detections(ims, y, files, dt, self.names, x.shape, sizes, shape0)
 
-            return Detections(ims, y, files, dt, self.names, x.shape)
+    @staticmethod
+    def _per_image(value, default, n):
+        """Expands a per-call NMS setting, a value or a per-image list with None for the default, to n values."""
+        values = value if isinstance(value, (list, tuple)) else [value] * n
+        return [default if v is None else v for v in values]
+
+    def _nms(self, y, settings, sparse=False):
+        """NMS of a batch with per-row (conf, iou, max_det) settings, one NMS call per distinct setting."""
+        groups = {}  # batch rows by settings
+        for i, s in enumerate(settings):
+            groups.setdefault(s, []).append(i)
+        if not sparse and isinstance(y, (list, tuple)):
+            y = y[0]  # inference output
+        output = [None] * len(settings)
+        for (conf, iou, max_det), idx in groups.items():
+            if sparse:  # flattened candidates of the sparse Detect head, with their batch row
+                b, d = y
+                row = torch.full((len(settings),), -1, dtype=b.dtype, device=b.device)
+                row[idx] = torch.arange(len(idx), dtype=b.dtype, device=b.device)  # batch row to group row
+                k = (row[b] >= 0) & (d[:, 4] > conf)
+                if self.classes is not None:
+                    k &= (d[:, 5:6] == torch.tensor(self.classes, device=d.device)).any(1)
+                r = batched_nms(d[k], row[b[k]], len(idx), iou, max_det=max_det)
+            else:
+                p = y if len(groups) == 1 else y[idx]
+                r = non_max_suppression(p, conf, iou, self.classes, self.agnostic, self.multi_label, max_det=max_det)
+            for i, ri in zip(idx, r):
+                output[i] = ri
+        return output
+
+    def adaptive_size(self, pred, shape, max_det=None, scale=1.0):
+        """Chooses the inference size of an image (or dish crop) of `shape` from its quick-pass detections, 0 to tile at
+        native resolution; `scale` is the native to `shape` size ratio of an image decoded at a reduced resolution.
+        """
+        sizes = self.adaptive_sizes
+        if not len(pred):  # nothing seen at low resolution, the objects may be too small
+            return sizes[1]
+        wh = pred[:, 2:4] - pred[:, :2]  # image pixels
+        box = float(wh.min(1).values.median()) * sizes[0] / max(shape)  # median box size in the quick pass
+        need = sizes[0] * self.adaptive_min_box / max(box, 1e-3)  # size at which the median box is large enough
+        if len(pred) >= self.adaptive_crowd:  # crowded, the neighbouring objects merge at low resolution
+            need = max(need, sizes[-1])
+        if len(pred) >= (max_det or self.max_det) // 2:  # close to the detections limit, tile to lift it
+            need = float("inf")
+        fits = [s for s in sizes if s >= need]
+        return fits[0] if fits else (0 if max(shape) * scale > sizes[-1] else sizes[-1])
+
+    def adaptive_forward(self, ims, augment=False, count=False, **kwargs):
+        """
+        Runs inference at an adaptive resolution: a quick pass at the smallest of `adaptive_sizes`, then a re-run of
+        only the images whose quick-pass detections are crowded or tiny, at the size they need (or tiled at native
+        resolution beyond the largest size). The chosen resolution of each image is reported in `sizes`, the times add
+        up both passes.
+        """
+        r = self(ims, size=self.adaptive_sizes[0], augment=augment, **kwargs)  # quick pass
+        pred, sizes, shapes, passes = list(r.pred), list(r.sizes), list(r.shapes), [r]
+        max_det = self._per_image(kwargs.get("max_det"), self.max_det, r.n)
+        groups = {}  # image indices by chosen size
+        for i, (p, shape) in enumerate(zip(r.pred, r.shapes)):
+            size = self.adaptive_size(p, shape, max_det[i])
+            if size != self.adaptive_sizes[0]:
+                groups.setdefault(size, []).append(i)
+        for size, idx in groups.items():
+            tile = 0 if size else self.adaptive_sizes[1]
+            kw = {k: [v[i] for i in idx] if isinstance(v, (list, tuple)) else v for k, v in kwargs.items()}  # subset
+            rr = self([r.ims[i] for i in idx], size=size or tile, augment=augment, tile=tile, **kw)
+            for i, p, s, h in zip(idx, rr.pred, rr.sizes, rr.shapes):
+                pred[i], sizes[i], shapes[i] = p, s, h
+            passes.append(rr)
+        dt = tuple(Profile(t=sum(x.times[k].t for x in passes)) for k in range(3))  # both passes
+        s = max((x.s for x in passes), key=lambda x: x[2] * x[3])  # shape of the largest inference batch
+        if count:
+            return Counts(pred, r.files, dt, self.names, s, sizes, shapes)
+        return Detections(r.ims, pred, r.files, dt, self.names, s, sizes, shapes)
 
 
 class Detections:
     # YOLOv5 detections class for inference results
-    def __init__(self, ims, pred, files, times=(0, 0, 0), names=None, shape=None):
+    def __init__(self, ims, pred, files, times=(0, 0, 0), names=None, shape=None, sizes=None, shapes=None):
         """Initializes the YOLOv5 Detections class with image info, predictions, filenames, timing and normalization."""
         super().__init__()
-        d = pred[0].device  # device
-        gn = [torch.tensor([*(im.shape[i] for i in [1, 0, 1, 0]), 1, 1], device=d) for im in ims]  # normalizations
         self.ims = ims  # list of images as numpy arrays
         self.pred = pred  # list of tensors pred[0] = (xyxy, conf, cls)
         self.names = names  # class names
         self.files = files  # image filenames
         self.times = times  # profiling times
-        self.xyxy = pred  # xyxy pixels
-        self.xywh = [xyxy2xywh(x) for x in pred]  # xywh pixels
-        self.xyxyn = [x / g for x, g in zip(self.xyxy, gn)]  # xyxy normalized
-        self.xywhn = [x / g for x, g in zip(self.xywh, gn)]  # xywh normalized
+        self.xyxy = pred  # xyxy pixels, other box formats are computed on first access
         self.n = len(self.pred)  # number of images (batch size)
         self.t = tuple(x.t / self.n * 1e3 for x in times)  # timestamps (ms)
         self.s = tuple(shape)  # inference BCHW shape
+        self.sizes = sizes or [max(self.s[2:])] * self.n  # inference resolution (longest side) of each image
+        self.shapes = shapes or [im.shape[:2] for im in ims]  # inference input (image or dish crop) shape of each image
+
+    @cached_property
+    def gn(self):
+        """Normalization gains whwh11 of each image, computed on first access."""
+        return [
+            torch.tensor([*(im.shape[i] for i in [1, 0, 1, 0]), 1, 1], device=x.device)
+            for im, x in zip(self.ims, self.pred)
+        ]
+
+    @cached_property
+    def xywh(self):
+        """Detections in xywh pixels, computed on first access."""
+        return [xyxy2xywh(x) for x in self.pred]
+
+    @cached_property
+    def xyxyn(self):
+        """Detections in normalized xyxy, computed on first access."""
+        return [x / g for x, g in zip(self.xyxy, self.gn)]
+
+    @cached_property
+    def xywhn(self):
+        """Detections in normalized xywh, computed on first access."""
+        return [x / g for x, g in zip(self.xywh, self.gn)]
 
     def _run(self, pprint=False, show=False, save=False, crop=False, render=False, labels=True, save_dir=Path("")):
         """Executes model predictions, displaying and/or saving outputs with optional crops and labels."""
+        if show or save or render or crop:
+            check_ultralytics()
+            from ultralytics.utils.plotting import Annotator, colors, save_one_box
+
         s, crops = "", []
         for i, (im, pred) in enumerate(zip(self.ims, self.pred)):
             s += f"\nimage {i + 1}/{len(self.pred)}: {im.shape[0]}x{im.shape[1]} "  # string
@@ -1000,6 +1154,8 @@ class Detections:
 
         Example: print(results.pandas().xyxy[0]).
         """
+        import pandas as pd
+
         new = copy(self)  # return copy
         ca = "xmin", "ymin", "xmax", "ymax", "confidence", "class", "name"  # xyxy columns
         cb = "xcenter", "ycenter", "width", "height", "confidence", "class", "name"  # xywh columns
@@ -1008,6 +1164,35 @@ class Detections:
             setattr(new, k, [pd.DataFrame(x, columns=c) for x in a])
         return new
 
+    def to_numpy(self, fmt="xyxy"):
+        """
+        Returns detections as a list of (n, 6) float32 numpy arrays (box, confidence, class) per image, without pandas.
+
+        Example: boxes = results.to_numpy('xywhn')[0]
+        """
+        return [x.cpu().numpy().astype(np.float32, copy=False) for x in getattr(self, fmt)]
+
+    def to_records(self, fmt="xyxy"):
+        """
+        Returns detections as numpy record arrays per image, with the columns of pandas() but without pandas.
+
+        Example: print(results.to_records()[0].confidence)
+        """
+        ca = "xmin", "ymin", "xmax", "ymax", "confidence"  # xyxy columns
+        cb = "xcenter", "ycenter", "width", "height", "confidence"  # xywh columns
+        columns = ca if fmt.startswith("xyxy") else cb
+        dtype = [(k, np.float32) for k in columns] + [("class", np.int64), ("name", object)]
+        names = np.array([self.names[i] for i in range(len(self.names))], dtype=object)  # class index to name
+        records = []
+        for a in self.to_numpy(fmt):
+            r = np.empty(len(a), dtype=dtype)
+            for k, x in zip(columns, a.T):
+                r[k] = x
+            r["class"] = a[:, 5]
+            r["name"] = names[r["class"]]
+            records.append(r.view(np.recarray))
+        return records
+
     def tolist(self):
         """
         Converts a Detections object into a list of individual detection results for iteration.
@@ -1023,10 +1208,16 @@ class Detections:
                 self.times,
                 self.names,
                 self.s,
+                [self.sizes[i]],
+                [self.shapes[i]],
             )
             for i in r
         ]
 
+    def counts(self):
+        """Returns the detection counts of these results as a Counts object, sharing the prediction tensors."""
+        return Counts(self.pred, self.files, self.times, self.names, self.s, self.sizes, self.shapes)
+
     def print(self):
         """Logs the string representation of the current object's state via the LOGGER."""
         LOGGER.info(self.__str__())
@@ -1046,6 +1237,74 @@ class Detections:
         return f"YOLOv5 {self.__class__} instance\n" + self.__str__()
 
 
+class Counts:
+    # YOLOv5 detection counts class for inference results, skips the box formats and DataFrames of Detections
+    def __init__(self, pred, files, times=(0, 0, 0), names=None, shape=None, sizes=None, shapes=None):
+        """Initializes the YOLOv5 Counts class with predictions, filenames, timing and class names."""
+        self.pred = pred  # list of tensors pred[0] = (xyxy, conf, cls)
+        self.names = names  # class names
+        self.files = files  # image filenames
+        self.times = times  # profiling times
+        self.n = len(self.pred)  # number of images (batch size)
+        self.t = tuple(x.t / self.n * 1e3 for x in times)  # timestamps (ms)
+        self.s = tuple(shape)  # inference BCHW shape
+        self.sizes = sizes or [max(self.s[2:])] * self.n  # inference resolution (longest side) of each image
+        self.shapes = shapes or [None] * self.n  # inference input (image or dish crop) shape of each image
+
+    def count(self, conf=0.0):
+        """
+        Returns the number of detections with a confidence above `conf` for each image.
+
+        Usage: count(conf=0.5)
+        """
+        return [int((x[:, 4] > conf).sum()) for x in self.pred]
+
+    def histogram(self, bins=10, conf=0.0):
+        """
+        Returns the bin edges and, for each image, the number of detections per confidence bin between `conf` and 1.
+
+        Usage: edges, counts = histogram(bins=10, conf=0.25)
+        """
+        if conf >= 1:  # empty range, histc would bin over the range of the data instead
+            return [conf] * (bins + 1), [[0] * bins for _ in self.pred]
+        edges = torch.linspace(conf, 1.0, bins + 1).tolist()
+        counts = [torch.histc(x[:, 4].float(), bins=bins, min=conf, max=1.0).int().tolist() for x in self.pred]
+        return edges, counts
+
+    def curve(self):
+        """
+        Returns, for each image, the count-vs-threshold curve: the ascending confidences and the number of detections at
+        or above each. The count above any threshold t is counts[bisect_right(thresholds, t)] (0 past the end).
+
+        Usage: thresholds, counts = curve()[0]
+        """
+        curves = []
+        for x in self.pred:
+            thresholds = x[:, 4].float().sort().values.tolist()
+            curves.append((thresholds, list(range(len(thresholds), 0, -1))))
+        return curves
+
+    def tolist(self):
+        """
+        Converts a Counts object into a list of individual counts results for iteration.
+
+        Example: for result in results.tolist():
+        """
+        return [
+            Counts([x], [f], self.times, self.names, self.s, [s], [h])
+            for x, f, s, h in zip(self.pred, self.files, self.sizes, self.shapes)
+        ]
+
+    def __len__(self):
+        """Returns the number of results stored, overrides the default len(results)."""
+        return self.n
+
+    def __str__(self):
+        """Returns a string representation of the counts of each image and the profiling times."""
+        s = "".join(f"image {i + 1}/{self.n}: {n} detections\n" for i, n in enumerate(self.count()))
+        return f"{s}Speed: %.1fms pre-process, %.1fms inference, %.1fms NMS per image at shape {self.s}" % self.t
+
+
 class Proto(nn.Module):
     # YOLOv5 mask Proto module for segmentation models
     def __init__(self, c1, c_=256, c2=32):
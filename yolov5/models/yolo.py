@@ -52,7 +52,6 @@ from models.common import (
 from models.experimental import MixConv2d
 from utils.autoanchor import check_anchor_order
 from utils.general import LOGGER, check_version, check_yaml, colorstr, make_divisible, print_args
-from utils.plots import feature_visualization
 from utils.torch_utils import (
     fuse_conv_and_bn,
     initialize_weights,
@@ -114,6 +113,34 @@ class Detect(nn.Module):
 
         return x if self.training else (torch.cat(z, 1),) if self.export else (torch.cat(z, 1), x)
 
+    def forward_sparse(self, x, conf_thres=0.25):
+        """
+        Single-class inference decoding only the anchors above `conf_thres`, returns their image index and (n,6)
+        candidates [xyxy, conf, cls].
+
+        conf = obj * cls <= obj, so the anchors whose objectness logit is below logit(conf_thres) are skipped before the
+        sigmoid, grid and anchor math. Stateless (no grid cache), safe for concurrent inference threads.
+        """
+        assert self.nc == 1 and self.no == 6, "forward_sparse() requires a single-class Detect head"
+        t = min(max(conf_thres, 1e-6), 1 - 1e-6)
+        lo = math.log(t / (1 - t))  # objectness logit threshold
+        b, z = [], []  # image index, candidates
+        for i in range(self.nl):
+            p = self.m[i](x[i])  # conv
+            bs, _, ny, nx = p.shape
+            p = p.view(bs, self.na, self.no, ny, nx)
+            j = (p[:, :, 4] > lo).nonzero(as_tuple=True)  # image, anchor, grid y, grid x of the candidates
+            s = p[j[0], j[1], :, j[2], j[3]].sigmoid()  # (n, 6)
+            g = torch.stack((j[3], j[2]), 1).to(s.dtype) - 0.5  # grid xy offset, i.e. y = 2.0 * x - 0.5
+            xy = (s[:, :2] * 2 + g) * self.stride[i]  # xy
+            wh = (s[:, 2:4] * 2) ** 2 * (self.anchors[i][j[1]] * self.stride[i]).to(s.dtype)  # wh
+            conf = s[:, 4:5] * s[:, 5:6]
+            z.append(torch.cat((xy - wh / 2, xy + wh / 2, conf, torch.zeros_like(conf)), 1))
+            b.append(j[0])
+        b, z = torch.cat(b), torch.cat(z)
+        k = z[:, 4] > conf_thres
+        return b[k], z[k]
+
     def _make_grid(self, nx=20, ny=20, i=0, torch_1_10=check_version(torch.__version__, "1.10.0")):
         """Generates a mesh grid for anchor boxes with optional compatibility for torch versions < 1.10."""
         d = self.anchors[i].device
@@ -167,9 +194,22 @@ class BaseModel(nn.Module):
             x = m(x)  # run
             y.append(x if m.i in self.save else None)  # save output
             if visualize:
+                from utils.plots import feature_visualization
+
                 feature_visualization(x, m.type, m.i, save_dir=visualize)
         return x
 
+    def forward_sparse(self, x, conf_thres=0.25):
+        """Single-scale inference through the sparse single-class Detect head, see Detect.forward_sparse()."""
+        y = []  # outputs
+        for m in self.model:
+            if m.f != -1:  # if not from previous layer
+                x = y[m.f] if isinstance(m.f, int) else [x if j == -1 else y[j] for j in m.f]  # from earlier layers
+            if m is self.model[-1]:
+                return m.forward_sparse(x, conf_thres)
+            x = m(x)  # run
+            y.append(x if m.i in self.save else None)  # save output
+
     def _profile_one_layer(self, m, x, dt):
         """Profiles a single layer's performance by computing GFLOPs, execution time, and parameters."""
         c = m == self.model[-1]  # is final layer, copy input as inplace fix
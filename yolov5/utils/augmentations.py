@@ -1,14 +1,18 @@
 # Ultralytics YOLOv5 🚀, AGPL-3.0 license
 """Image augmentation functions."""
 
+import functools
 import math
 import random
+import threading
+from collections import OrderedDict
 
 import cv2
 import numpy as np
 import torch
 import torchvision.transforms as T
 import torchvision.transforms.functional as TF
+from PIL import Image
 
 from utils.general import LOGGER, check_version, colorstr, resample_segments, segment2box, xywhn2xyxy
 from utils.metrics import bbox_ioa
@@ -118,12 +122,36 @@ def replicate(im, labels):
     return im, labels
 
 
-def letterbox(im, new_shape=(640, 640), color=(114, 114, 114), auto=True, scaleFill=False, scaleup=True, stride=32):
-    """Resizes and pads image to new_shape with stride-multiple constraints, returns resized image, ratio, padding."""
-    shape = im.shape[:2]  # current shape [height, width]
-    if isinstance(new_shape, int):
-        new_shape = (new_shape, new_shape)
+def exif_transpose(image):
+    """
+    Transpose a PIL image accordingly if it has an EXIF Orientation tag.
+    Inplace version of https://github.com/python-pillow/Pillow/blob/master/src/PIL/ImageOps.py exif_transpose()
 
+    :param image: The image to transpose.
+    :return: An image.
+    """
+    exif = image.getexif()
+    orientation = exif.get(0x0112, 1)  # default 1
+    if orientation > 1:
+        method = {
+            2: Image.FLIP_LEFT_RIGHT,
+            3: Image.ROTATE_180,
+            4: Image.FLIP_TOP_BOTTOM,
+            5: Image.TRANSPOSE,
+            6: Image.ROTATE_270,
+            7: Image.TRANSVERSE,
+            8: Image.ROTATE_90,
+        }.get(orientation)
+        if method is not None:
+            image = image.transpose(method)
+            del exif[0x0112]
+            image.info["exif"] = exif.tobytes()
+    return image
+
+
+@functools.lru_cache(maxsize=64)
+def letterbox_geometry(shape, new_shape=(640, 640), auto=True, scaleFill=False, scaleup=True, stride=32):
+    """Returns the letterbox resized (w, h), ratio, padding and (top, bottom, left, right) borders of an image shape."""
     # Scale ratio (new / old)
     r = min(new_shape[0] / shape[0], new_shape[1] / shape[1])
     if not scaleup:  # only scale down, do not scale up (for better val mAP)
@@ -142,13 +170,120 @@ def letterbox(im, new_shape=(640, 640), color=(114, 114, 114), auto=True, scaleF
 
     dw /= 2  # divide padding into 2 sides
     dh /= 2
-
-    if shape[::-1] != new_unpad:  # resize
-        im = cv2.resize(im, new_unpad, interpolation=cv2.INTER_LINEAR)
     top, bottom = int(round(dh - 0.1)), int(round(dh + 0.1))
     left, right = int(round(dw - 0.1)), int(round(dw + 0.1))
-    im = cv2.copyMakeBorder(im, top, bottom, left, right, cv2.BORDER_CONSTANT, value=color)  # add border
-    return im, ratio, (dw, dh)
+    return new_unpad, ratio, (dw, dh), (top, bottom, left, right)
+
+
+def letterbox(
+    im, new_shape=(640, 640), color=(114, 114, 114), auto=True, scaleFill=False, scaleup=True, stride=32, dst=None
+):
+    """Resizes and pads image to new_shape with stride-multiple constraints, returns resized image, ratio, padding.
+
+    The image is resized straight into its padded destination when the destination rows are contiguous (padding on
+    top and bottom only), else resized then padded, `dst` is reused when it has the output shape and dtype.
+    """
+    if isinstance(new_shape, int):
+        new_shape = (new_shape, new_shape)
+    (w, h), ratio, pad, (top, bottom, left, right) = letterbox_geometry(
+        im.shape[:2], tuple(new_shape), auto, scaleFill, scaleup, stride
+    )
+    shape = (top + h + bottom, left + w + right) + im.shape[2:]
+    if dst is None or dst.shape != shape or dst.dtype != im.dtype:
+        dst = np.empty(shape, im.dtype)
+    if (left or right) and im.shape[1::-1] != (w, h):  # resizing into a strided view is slower, resize then pad
+        im = cv2.resize(im, (w, h), interpolation=cv2.INTER_LINEAR)
+        out = cv2.copyMakeBorder(im, top, bottom, left, right, cv2.BORDER_CONSTANT, dst=dst, value=color)
+        if not np.may_share_memory(out, dst):  # OpenCV did not write into dst
+            dst[:] = out
+        return dst, ratio, pad
+
+    # Fill the borders only, the resized image overwrites the rest
+    fill = (tuple(color) + (0,) * im.shape[2])[: im.shape[2]] if im.ndim == 3 else color[0]
+    dst[:top] = fill
+    dst[top + h :] = fill
+    dst[top : top + h, :left] = fill
+    dst[top : top + h, left + w :] = fill
+    roi = dst[top : top + h, left : left + w]
+    if im.shape[1::-1] != (w, h):  # resize
+        out = cv2.resize(im, (w, h), dst=roi, interpolation=cv2.INTER_LINEAR)
+        if not np.may_share_memory(out, roi):  # OpenCV did not write into the view
+            roi[:] = out
+    else:
+        roi[:] = im
+    return dst, ratio, pad
+
+
+class InputBuffers:
+    # Reusable (B,3,H,W) float32 model input buffers, one set per thread, images are written in place in a single pass
+    def __init__(self, max_shapes=4, max_bytes=2**27, pin=False):
+        """Initializes per-thread buffer caches of up to `max_shapes` input shapes and `max_bytes` bytes, pinned for
+        faster GPU copies.
+        """
+        self.max_shapes = max_shapes
+        self.max_bytes = max_bytes
+        self.pin = pin and torch.cuda.is_available()
+        self.local = threading.local()
+
+    def __getstate__(self):
+        """Returns the settings only for pickling and deep copies, the per-thread buffers are not shared."""
+        return {k: v for k, v in self.__dict__.items() if k != "local"}
+
+    def __setstate__(self, state):
+        """Restores the settings with empty per-thread buffers."""
+        self.__dict__.update(state)
+        self.local = threading.local()
+
+    def get(self, n, h, w):
+        """Returns an (n,3,h,w) buffer of the calling thread, reused across calls of the same (h, w) unless larger than
+        `max_bytes`.
+        """
+        cache = getattr(self.local, "cache", None)
+        if cache is None:
+            cache = self.local.cache = OrderedDict()  # (h, w): buffer, least recently used first
+        buf = cache.pop((h, w), None)
+        if buf is None or len(buf) < n:  # grow to the largest batch size seen
+            new = torch.empty((n, 3, h, w), dtype=torch.float32, pin_memory=self.pin)
+            if new.nbytes > self.max_bytes:  # too large to keep, e.g. the tiles of a large image
+                if buf is not None:
+                    cache[(h, w)] = buf
+                return new
+            buf = new
+        cache[(h, w)] = buf
+        while len(cache) > self.max_shapes or sum(b.nbytes for b in cache.values()) > self.max_bytes:
+            cache.popitem(last=False)
+        return buf[:n]
+
+    @staticmethod
+    def write(dst, im, bgr=False):
+        """Writes an HWC uint8 image into a (3,h,w) buffer slice, fusing HWC to CHW, BGR to RGB and 0-255 to 0.0-1.0."""
+        t = torch.from_numpy(im)
+        if bgr:
+            for c in range(3):
+                torch.mul(t[..., 2 - c], 1 / 255, out=dst[c])
+        else:
+            torch.mul(t.permute(2, 0, 1), 1 / 255, out=dst)
+        return dst
+
+    def letterbox(self, ims, shape, bgr=False):
+        """Letterboxes HWC uint8 images to shape (h, w) into a reused (B,3,h,w) buffer via a uint8 scratch."""
+        x = self.get(len(ims), *shape)
+        for i, im in enumerate(ims):
+            self.local.scratch = letterbox(im, shape, auto=False, dst=getattr(self.local, "scratch", None))[0]
+            self.write(x[i], self.local.scratch, bgr)
+        return x
+
+    def tiles(self, ims, windows, tile=640, bgr=False):
+        """Crops HWC uint8 images into their padded (x1, y1, x2, y2) tile windows into a reused (T,3,t,t) buffer."""
+        x = self.get(sum(len(w) for w in windows), tile, tile)
+        i = 0
+        for im, ws in zip(ims, windows):
+            for x1, y1, x2, y2 in ws:
+                if x2 - x1 < tile or y2 - y1 < tile:  # pad bottom-right
+                    x[i].fill_(114 / 255)
+                self.write(x[i, :, : y2 - y1, : x2 - x1], im[y1:y2, x1:x2], bgr)
+                i += 1
+        return x
 
 
 def random_perspective(
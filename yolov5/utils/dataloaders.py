@@ -32,6 +32,7 @@ from utils.augmentations import (
     classify_albumentations,
     classify_transforms,
     copy_paste,
+    exif_transpose,  # noqa: F401 (re-exported, moved to utils.augmentations)
     letterbox,
     mixup,
     random_perspective,
@@ -90,33 +91,6 @@ def exif_size(img):
     return s
 
 
-def exif_transpose(image):
-    """
-    Transpose a PIL image accordingly if it has an EXIF Orientation tag.
-    Inplace version of https://github.com/python-pillow/Pillow/blob/master/src/PIL/ImageOps.py exif_transpose()
-
-    :param image: The image to transpose.
-    :return: An image.
-    """
-    exif = image.getexif()
-    orientation = exif.get(0x0112, 1)  # default 1
-    if orientation > 1:
-        method = {
-            2: Image.FLIP_LEFT_RIGHT,
-            3: Image.ROTATE_180,
-            4: Image.FLIP_TOP_BOTTOM,
-            5: Image.TRANSPOSE,
-            6: Image.ROTATE_270,
-            7: Image.TRANSVERSE,
-            8: Image.ROTATE_90,
-        }.get(orientation)
-        if method is not None:
-            image = image.transpose(method)
-            del exif[0x0112]
-            image.info["exif"] = exif.tobytes()
-    return image
-
-
 def seed_worker(worker_id):
     """
     Sets the seed for a dataloader worker to ensure reproducibility, based on PyTorch's randomness notes.
@@ -6,7 +6,6 @@ import subprocess
 import urllib
 from pathlib import Path
 
-import requests
 import torch
 
 
@@ -33,6 +32,8 @@ def gsutil_getsize(url=""):
 
 def url_getsize(url="https://ultralytics.com/images/bus.jpg"):
     """Returns the size in bytes of a downloadable file at a given URL; defaults to -1 if not found."""
+    import requests
+
     response = requests.head(url, allow_redirects=True)
     return int(response.headers.get("content-length", -1))
 
@@ -89,6 +90,8 @@ def attempt_download(file, repo="ultralytics/yolov5", release="v7.0"):
     """Downloads a file from GitHub release assets or via direct URL if not found locally, supporting backup
     versions.
     """
+    import requests
+
     from utils.general import LOGGER
 
     def github_assets(repository, version="latest"):
@@ -18,7 +18,7 @@ import time
 import urllib
 from copy import deepcopy
 from datetime import datetime
-from itertools import repeat
+from itertools import combinations, repeat
 from multiprocessing.pool import ThreadPool
 from pathlib import Path
 from subprocess import check_output
@@ -28,26 +28,11 @@ from zipfile import ZipFile, is_zipfile
 
 import cv2
 import numpy as np
-import pandas as pd
-import pkg_resources as pkg
 import torch
 import torchvision
 import yaml
 
-# Import 'ultralytics' package or install if missing
-try:
-    import ultralytics
-
-    assert hasattr(ultralytics, "__version__")  # verify package is not directory
-except (ImportError, AssertionError):
-    os.system("pip install -U ultralytics")
-    import ultralytics
-
-from ultralytics.utils.checks import check_requirements
-
 from utils import TryExcept, emojis
-from utils.downloads import curl_download, gsutil_getsize
-from utils.metrics import box_iou, fitness
 
 FILE = Path(__file__).resolve()
 ROOT = FILE.parents[1]  # YOLOv5 root directory
@@ -63,7 +48,6 @@ FONT = "Arial.ttf"  # https://github.com/ultralytics/assets/releases/download/v0
 
 torch.set_printoptions(linewidth=320, precision=5, profile="long")
 np.set_printoptions(linewidth=320, formatter={"float_kind": "{:11.5g}".format})  # format short g, %precision=5
-pd.options.display.max_columns = 10
 cv2.setNumThreads(0)  # prevent OpenCV from multithreading (incompatible with PyTorch DataLoader)
 os.environ["NUMEXPR_MAX_THREADS"] = str(NUM_THREADS)  # NumExpr max threads
 os.environ["OMP_NUM_THREADS"] = "1" if platform.system() == "darwin" else str(NUM_THREADS)  # OpenMP (PyTorch and SciPy)
@@ -415,6 +399,28 @@ def check_git_info(path="."):
         return {"remote": None, "branch": None, "commit": None}
 
 
+def check_ultralytics():
+    """Imports the 'ultralytics' package on first use, installing it if missing, and returns it."""
+    try:
+        import ultralytics
+
+        assert hasattr(ultralytics, "__version__")  # verify package is not directory
+    except (ImportError, AssertionError):
+        os.system("pip install -U ultralytics")
+        import ultralytics
+    return ultralytics
+
+
+def check_requirements(*args, **kwargs):
+    """Checks installed dependencies meet requirements, see `ultralytics.utils.checks.check_requirements()`; the
+    'ultralytics' import is deferred to the first call to keep it off the inference import path.
+    """
+    check_ultralytics()
+    from ultralytics.utils.checks import check_requirements
+
+    return check_requirements(*args, **kwargs)
+
+
 def check_python(minimum="3.8.0"):
     """Checks if current Python version meets the minimum required version, exits if not."""
     check_version(platform.python_version(), minimum, name="Python ", hard=True)
@@ -422,7 +428,11 @@ def check_python(minimum="3.8.0"):
 
 def check_version(current="0.0.0", minimum="0.0.0", name="version ", pinned=False, hard=False, verbose=False):
     """Checks if the current version meets the minimum required version, exits or warns based on parameters."""
-    current, minimum = (pkg.parse_version(x) for x in (current, minimum))
+    try:
+        from packaging.version import parse as parse_version  # lightweight, avoids importing pkg_resources
+    except ImportError:
+        from pkg_resources import parse_version
+    current, minimum = (parse_version(x) for x in (current, minimum))
     result = (current == minimum) if pinned else (current >= minimum)  # bool
     s = f"WARNING ⚠️ {name}{minimum} is required by YOLOv5, but {name}{current} is currently installed"  # string
     if hard:
@@ -661,6 +671,8 @@ def download(url, dir=".", unzip=True, delete=True, curl=False, threads=1, retry
             LOGGER.info(f"Downloading {url} to {f}...")
             for i in range(retry + 1):
                 if curl:
+                    from utils.downloads import curl_download
+
                     success = curl_download(url, f, silent=(threads > 1))
                 else:
                     torch.hub.download_url_to_file(url, f, progress=threads == 1)  # torch download
@@ -1016,10 +1028,17 @@ def non_max_suppression(
     labels=(),
     max_det=300,
     nm=0,  # number of masks
+    time_limit=None,
+    strict=False,
 ):
     """
     Non-Maximum Suppression (NMS) on inference results to reject overlapping detections.
 
+    The candidates of all the images are filtered in one pass and suppressed by `batched_nms()`, with a single NMS
+    call for small batches of candidates. Single-class models skip the class max, multi-label and class offset work.
+    `time_limit` (seconds, None for 0.5 + 0.05 * batch size, 0 to disable) is checked once NMS is done: results are
+    never truncated, exceeding it logs a warning, or raises TimeoutError if `strict`.
+
     Returns:
          list of detections, on (n,6) tensor per image [xyxy, conf, cls]
     """
@@ -1036,88 +1055,236 @@ def non_max_suppression(
         prediction = prediction.cpu()
     bs = prediction.shape[0]  # batch size
     nc = prediction.shape[2] - nm - 5  # number of classes
-    xc = prediction[..., 4] > conf_thres  # candidates
 
     # Settings
-    # min_wh = 2  # (pixels) minimum box width and height
-    max_wh = 7680  # (pixels) maximum box width and height
-    max_nms = 30000  # maximum number of boxes into torchvision.ops.nms()
-    time_limit = 0.5 + 0.05 * bs  # seconds to quit after
-    redundant = True  # require redundant detections
+    max_nms = 30000  # maximum number of boxes per image into torchvision.ops.nms()
+    time_limit = 0.5 + 0.05 * bs if time_limit is None else time_limit  # seconds
     multi_label &= nc > 1  # multiple labels per box (adds 0.5ms/img)
-    merge = False  # use merge-NMS
 
     t = time.time()
     mi = 5 + nc  # mask start index
-    output = [torch.zeros((0, 6 + nm), device=prediction.device)] * bs
-    for xi, x in enumerate(prediction):  # image index, image inference
-        # Apply constraints
-        # x[((x[..., 2:4] < min_wh) | (x[..., 2:4] > max_wh)).any(1), 4] = 0  # width-height
-        x = x[xc[xi]]  # confidence
-
-        # Cat apriori labels if autolabelling
-        if labels and len(labels[xi]):
-            lb = labels[xi]
-            v = torch.zeros((len(lb), nc + nm + 5), device=x.device)
-            v[:, :4] = lb[:, 1:5]  # box
-            v[:, 4] = 1.0  # conf
-            v[range(len(lb)), lb[:, 0].long() + 5] = 1.0  # cls
-            x = torch.cat((x, v), 0)
-
-        # If none remain process next image
-        if not x.shape[0]:
-            continue
+    b, a = (prediction[..., 4] > conf_thres).nonzero(as_tuple=True)  # image and anchor index of the candidates
+    x = prediction[b, a]
+
+    # Cat apriori labels if autolabelling
+    if labels and any(len(lb) for lb in labels):
+        v = torch.zeros((sum(len(lb) for lb in labels), nc + nm + 5), device=x.device)
+        lb = torch.cat([lb for lb in labels if len(lb)])
+        v[:, :4] = lb[:, 1:5]  # box
+        v[:, 4] = 1.0  # conf
+        v[range(len(lb)), lb[:, 0].long() + 5] = 1.0  # cls
+        x = torch.cat((x, v), 0)
+        b = torch.cat((b, torch.cat([torch.full((len(lb),), i, device=b.device) for i, lb in enumerate(labels)])))
+
+    # Detections matrix nx6 (xyxy, conf, cls)
+    box = xywh2xyxy(x[:, :4])  # center_x, center_y, width, height) to (x1, y1, x2, y2)
+    mask = x[:, mi:]  # zero columns if no masks
+    if nc == 1:  # single class, conf = obj_conf * cls_conf and class 0
+        conf = x[:, 4:5] * x[:, 5:6]
+        x = torch.cat((box, conf, torch.zeros_like(conf), mask), 1)
+        i = conf.view(-1) > conf_thres
+        x, b = x[i], b[i]
+    elif multi_label:
+        x[:, 5:mi] *= x[:, 4:5]  # conf = obj_conf * cls_conf
+        i, j = (x[:, 5:mi] > conf_thres).nonzero(as_tuple=False).T
+        x, b = torch.cat((box[i], x[i, 5 + j, None], j[:, None].float(), mask[i]), 1), b[i]
+    else:  # best class only
+        conf, j = (x[:, 5:mi] * x[:, 4:5]).max(1, keepdim=True)
+        i = conf.view(-1) > conf_thres
+        x, b = torch.cat((box, conf, j.float(), mask), 1)[i], b[i]
+
+    # Filter by class
+    if classes is not None:
+        i = (x[:, 5:6] == torch.tensor(classes, device=x.device)).any(1)
+        x, b = x[i], b[i]
+
+    # Batched NMS, one call for all the images
+    output = batched_nms(x, b, bs, iou_thres, agnostic or nc == 1, max_det, max_nms)
+    if mps:
+        output = [xi.to(device) for xi in output]
+
+    dt = time.time() - t
+    if time_limit and dt > time_limit:
+        msg = f"NMS time limit {time_limit:.3f}s exceeded ({dt:.3f}s for {bs} images)"
+        if strict:
+            raise TimeoutError(msg)
+        LOGGER.warning(f"WARNING ⚠️ {msg}")
+    return output
+
+
+def batched_nms(x, b, bs, iou_thres=0.45, agnostic=False, max_det=300, max_nms=30000):
+    """
+    NMS of the flattened candidates (n,6+nm) [xyxy, conf, cls, masks] of image index `b`.
+
+    Small batches of candidates of several images are suppressed with a single NMS call, the boxes being offset by
+    image and class index. The cost of the single call grows with the candidates of all the images, beyond 500
+    candidates on CPU (20000 on GPU) a loop over the images, each with its own NMS call, is faster.
 
-        # Compute conf
-        x[:, 5:] *= x[:, 4:5]  # conf = obj_conf * cls_conf
+    Returns:
+         list of detections, on (n,6+nm) tensor per image of the batch of size `bs`
+    """
+    if len(x):
+        n = torch.bincount(b, minlength=bs)
+        if n.max() > max_nms or (b[1:] < b[:-1]).any():  # remove excess boxes, sort by image
+            i = _per_image_top(b, x[:, 4], max_nms)
+            x, b = x[i], b[i]
+            n = torch.bincount(b, minlength=bs)
+        if bs > 1 and len(x) <= (500 if x.device.type == "cpu" else 20000):  # one NMS call for the batch
+            i = _nms(x, iou_thres, agnostic, b)
+            i = i[_per_image_top(b[i], x[i, 4], max_det)]  # limit detections, sorted by image
+        else:  # one NMS call per image, already sorted by image
+            n = n.tolist()
+            start = np.cumsum([0, *n]).tolist()
+            i = [_nms(xi, iou_thres, agnostic)[:max_det] + s for xi, s in zip(x.split(n), start) if len(xi)]
+            i = torch.cat(i)
+        x, b = x[i], b[i]
+    return list(x.split(torch.bincount(b, minlength=bs).tolist()))
+
+
+def _nms(x, iou_thres=0.45, agnostic=False, b=None):
+    """Returns the indices kept by NMS of the candidates (n,6+nm), boxes offset by class and image index `b` if set."""
+    g = None if agnostic else x[:, 5].long()  # NMS group (image and class)
+    if b is not None:
+        g = b if g is None else b * (int(x[:, 5].max()) + 1) + g
+    if g is None:
+        return torchvision.ops.nms(x[:, :4], x[:, 4], iou_thres)
+    offset = g[:, None].to(x.dtype) * (x[:, :4].max() - x[:, :4].min() + 1)  # groups never overlap
+    return torchvision.ops.nms(x[:, :4] + offset, x[:, 4], iou_thres)
+
+
+def _per_image_top(b, scores, k):
+    """Returns the indices of the k highest scores of each image index `b`, sorted by image and decreasing score."""
+    i = scores.argsort(descending=True)
+    i = i[b[i].sort(stable=True)[1]]  # by image, then by decreasing score
+    bi = b[i]
+    rank = torch.arange(len(i), device=b.device) - torch.searchsorted(bi, bi)  # rank within its image
+    return i[rank < k]
+
+
+def find_dish(im, size=256):
+    """
+    Finds the Petri dish of an HWC RGB image, returns its circle (cx, cy, r) in pixels or None if no dish is found.
+
+    Runs a Hough circle transform on a downsampled grayscale copy, with an Otsu threshold + largest contour fallback.
+    """
+    h, w = im.shape[:2]
+    g = size / max(h, w)  # gain
+    gray = cv2.resize(im, (max(1, round(w * g)), max(1, round(h * g))), interpolation=cv2.INTER_AREA)
+    gray = cv2.medianBlur(cv2.cvtColor(gray, cv2.COLOR_RGB2GRAY) if gray.ndim == 3 else gray, 5)
+    m, M = min(gray.shape), max(gray.shape)
+    circles = cv2.HoughCircles(
+        gray, cv2.HOUGH_GRADIENT, dp=1.5, minDist=M, param1=100, param2=30, minRadius=m // 4, maxRadius=int(M * 0.6)
+    )
+    if circles is not None:
+        cx, cy, r = circles[0, 0]  # strongest circle
+    else:
+        _, mask = cv2.threshold(gray, 0, 255, cv2.THRESH_BINARY + cv2.THRESH_OTSU)
+        contours, _ = cv2.findContours(mask, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+        if not contours:
+            return None
+        (cx, cy), r = cv2.minEnclosingCircle(max(contours, key=cv2.contourArea))
+        if not m / 4 <= r <= M * 0.6:  # not a dish, e.g. the whole background
+            return None
+    return float(cx) / g, float(cy) / g, float(r) / g
 
-        # Box/Mask
-        box = xywh2xyxy(x[:, :4])  # center_x, center_y, width, height) to (x1, y1, x2, y2)
-        mask = x[:, mi:]  # zero columns if no masks
 
-        # Detections matrix nx6 (xyxy, conf, cls)
-        if multi_label:
-            i, j = (x[:, 5:mi] > conf_thres).nonzero(as_tuple=False).T
-            x = torch.cat((box[i], x[i, 5 + j, None], j[:, None].float(), mask[i]), 1)
-        else:  # best class only
-            conf, j = x[:, 5:mi].max(1, keepdim=True)
-            x = torch.cat((box, conf, j.float(), mask), 1)[conf.view(-1) > conf_thres]
+def dish_window(dish, shape, pad=0.02):
+    """Returns the (x1, y1, x2, y2) bounding square of a dish circle (cx, cy, r), padded and clipped to shape (h, w)."""
+    cx, cy, r = dish
+    r *= 1 + pad
+    h, w = shape[:2]
+    return max(0, int(cx - r)), max(0, int(cy - r)), min(w, math.ceil(cx + r)), min(h, math.ceil(cy + r))
 
-        # Filter by class
-        if classes is not None:
-            x = x[(x[:, 5:6] == torch.tensor(classes, device=x.device)).any(1)]
 
-        # Apply finite constraint
-        # if not torch.isfinite(x).all():
-        #     x = x[torch.isfinite(x).all(1)]
+def in_dish(boxes, dish, pad=0.02):
+    """Returns the mask of the (n,4) xyxy boxes whose centers lie inside a dish circle (cx, cy, r), padded."""
+    cx, cy, r = dish
+    x = (boxes[:, 0] + boxes[:, 2]) / 2 - cx
+    y = (boxes[:, 1] + boxes[:, 3]) / 2 - cy
+    return x * x + y * y <= (r * (1 + pad)) ** 2
 
-        # Check shape
-        n = x.shape[0]  # number of boxes
-        if not n:  # no boxes
-            continue
-        x = x[x[:, 4].argsort(descending=True)[:max_nms]]  # sort by confidence and remove excess boxes
-
-        # Batched NMS
-        c = x[:, 5:6] * (0 if agnostic else max_wh)  # classes
-        boxes, scores = x[:, :4] + c, x[:, 4]  # boxes (offset by class), scores
-        i = torchvision.ops.nms(boxes, scores, iou_thres)  # NMS
-        i = i[:max_det]  # limit detections
-        if merge and (1 < n < 3e3):  # Merge NMS (boxes merged using weighted mean)
-            # update boxes as boxes(i,4) = weights(i,n) * boxes(n,4)
-            iou = box_iou(boxes[i], boxes) > iou_thres  # iou matrix
-            weights = iou * scores[None]  # box weights
-            x[i, :4] = torch.mm(weights, x[:, :4]).float() / weights.sum(1, keepdim=True)  # merged boxes
-            if redundant:
-                i = i[iou.sum(1) > 1]  # require redundancy
-
-        output[xi] = x[i]
-        if mps:
-            output[xi] = output[xi].to(device)
-        if (time.time() - t) > time_limit:
-            LOGGER.warning(f"WARNING ⚠️ NMS time limit {time_limit:.3f}s exceeded")
-            break  # time limit exceeded
 
-    return output
+def tile_windows(shape, tile=640, overlap=0.2):
+    """Returns the (x1, y1, x2, y2) windows of the overlapping tile x tile crops covering an image of shape (h, w)."""
+    step = max(1, int(tile * (1 - overlap)))  # stride between two tiles
+
+    def starts(n):
+        """Returns the tile start positions along an axis of n pixels, the last tile ends on the image border."""
+        return [0] if n <= tile else [*range(0, n - tile, step), n - tile]
+
+    h, w = shape[:2]
+    return [(x, y, min(x + tile, w), min(y + tile, h)) for y in starts(h) for x in starts(w)]
+
+
+def tile_images(im, windows, tile=640):
+    """Crops an HWC image into its tile windows, padded bottom-right to tile x tile, returns (n, tile, tile, c)."""
+    tiles = np.full((len(windows), tile, tile, im.shape[2]), 114, dtype=im.dtype)
+    for i, (x1, y1, x2, y2) in enumerate(windows):
+        tiles[i, : y2 - y1, : x2 - x1] = im[y1:y2, x1:x2]
+    return tiles
+
+
+def merge_tiles(pred, windows, iou_thres=0.45, agnostic=False, method="nms", ios_thres=0.6, margin=2):
+    """
+    Shifts per-tile detections (n,6) [xyxy, conf, cls] to image coordinates and merges duplicates across tile seams.
+
+    Two detections of different tiles are duplicates when their IoU exceeds `iou_thres`, as within a tile. A detection
+    cut by an inner border of its tile (within `margin` pixels) is also a duplicate of the complete box found by the
+    neighbouring tile when their intersection over the smaller box exceeds `ios_thres`, whatever their IoU. Only the
+    pairs of overlapping tiles are compared, and only their detections lying in the overlap of the two windows.
+    `method='nms'` keeps the most confident detection, `method='wbf'` fuses the boxes with a confidence-weighted mean
+    (weighted box fusion).
+    """
+    offsets = [torch.tensor([x1, y1, x1, y1], device=p.device, dtype=p.dtype) for p, (x1, y1, *_) in zip(pred, windows)]
+    x = torch.cat([torch.cat((p[:, :4] + o, p[:, 4:]), 1) for p, o in zip(pred, offsets)])
+    if len(windows) < 2 or len(x) < 2:
+        return x
+    t = torch.cat([torch.full((len(p),), i, device=x.device) for i, p in enumerate(pred)])  # tile index
+    order = x[:, 4].argsort(descending=True)
+    x, t = x[order], t[order]
+
+    # Duplicate pairs (higher, lower confidence index), only between detections in the overlap of two tiles
+    b = x[:, :4]
+    w = torch.tensor(windows, device=x.device, dtype=x.dtype)
+    near = (b[:, None, :2] < w[None, :, 2:]).all(2) & (b[:, None, 2:] > w[None, :, :2]).all(2)  # box meets window
+    area = (b[:, 2:] - b[:, :2]).clamp(0).prod(1)
+    wt, inner = w[t], torch.cat((w[:, :2] > 0, w[:, 2:] < w[:, 2:].max(0).values), 1)[t]  # tile window, inner borders
+    cut = torch.cat((b[:, :2] <= wt[:, :2] + margin, b[:, 2:] >= wt[:, 2:] - margin), 1)
+    cut = (cut & inner).any(1)  # box cut by an inner border of its tile
+    pairs = []
+    for i, j in combinations(range(len(windows)), 2):
+        if not (w[i, :2] < w[j, 2:]).all() or not (w[j, :2] < w[i, 2:]).all():
+            continue  # tiles without overlap
+        a, c = (near[:, j] & (t == i)).nonzero().flatten(), (near[:, i] & (t == j)).nonzero().flatten()
+        if not len(a) or not len(c):
+            continue
+        p, q = b[a, None], b[None, c]
+        inter = (torch.min(p[..., 2:], q[..., 2:]) - torch.max(p[..., :2], q[..., :2])).clamp(0).prod(2)
+        union = area[a, None] + area[None, c] - inter
+        ios = inter / torch.min(area[a, None], area[None, c]).clamp(1e-7)
+        dup = (inter / union.clamp(1e-7) > iou_thres) | ((ios > ios_thres) & (cut[a, None] | cut[None, c]))
+        if not agnostic:
+            dup &= x[a, None, 5] == x[None, c, 5]
+        k, m = dup.nonzero(as_tuple=True)
+        pairs.append(torch.stack((a[k], c[m]), 1).sort(1).values)
+    if not pairs:
+        return x
+
+    # Greedy merge in order of confidence, only the detections with duplicates are visited
+    dups = {}  # lower confidence duplicates of each detection
+    for i, j in torch.cat(pairs).tolist():
+        dups.setdefault(i, []).append(j)
+    kept = [True] * len(x)
+    for i in sorted(dups):
+        if kept[i]:
+            j = [k for k in dups[i] if kept[k]]
+            if method == "wbf" and j:
+                k = torch.tensor([i, *j], device=x.device)
+                v = x[k, 4:5]
+                x[i, :4] = (x[k, :4] * v).sum(0) / v.sum()
+            for k in j:
+                kept[k] = False
+    return x[torch.tensor(kept, device=x.device)]
 
 
 def strip_optimizer(f="best.pt", s=""):
@@ -1143,6 +1310,11 @@ def strip_optimizer(f="best.pt", s=""):
 
 def print_mutation(keys, results, hyp, save_dir, bucket, prefix=colorstr("evolve: ")):
     """Logs evolution results and saves to CSV and YAML in `save_dir`, optionally syncs with `bucket`."""
+    import pandas as pd
+
+    from utils.downloads import gsutil_getsize
+    from utils.metrics import fitness
+
     evolve_csv = save_dir / "evolve.csv"
     evolve_yaml = save_dir / "hyp_evolve.yaml"
     keys = tuple(keys) + tuple(hyp.keys())  # [results + hyps]